@@ -0,0 +1,140 @@
+''' google_standin.py: Local stand-in for the Google Pay API for Passes
+
+Answers OAuth token, object REST and multipart batch requests so the Google sync
+layer can be tested and timed without touching Google's servers.
+
+Usage:
+    python examples/google_standin.py --credentials certificates/standin.json
+    # then in config.py
+    GOOGLE_API_URI = 'http://localhost:8010'
+    SERVICE_ACCOUNT_FILE = 'certificates/standin.json'
+'''
+
+import argparse, json, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Cryptodome.PublicKey import RSA
+
+stats = {'requests': 0, 'batches': 0, 'calls': 0}
+resources = {}
+lock = threading.Lock()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+
+    def send(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, method, path, body):
+        # simulated result of a single REST call, resources are kept in memory
+        if random.random() < self.fail_rate:
+            return 503, json.dumps({'error': {'code': 503, 'message': 'stand-in failure'}})
+        resource = json.loads(body) if body.strip() else {}
+        with lock:
+            if method == 'POST':
+                if resource['id'] in resources:
+                    return 409, json.dumps({'error': {'code': 409, 'message': 'already exists'}})
+                resources[resource['id']] = resource
+            else:
+                resource_id = path.rstrip('/').split('/')[-1]
+                if resource_id not in resources:
+                    return 404, json.dumps({'error': {'code': 404, 'message': 'not found'}})
+                if method == 'PUT':
+                    resources[resource_id] = resource
+                elif method == 'PATCH':
+                    resources[resource_id].update(resource)
+                resource = resources[resource_id]
+        return 200, json.dumps(resource)
+
+    def handle_call(self):
+        body = self.read_body()
+        with lock:
+            stats['requests'] += 1
+        time.sleep(self.latency)
+
+        if self.path == '/token':
+            self.send(200, json.dumps({'access_token': 'standin', 'expires_in': 3600, 'token_type': 'Bearer'}))
+        elif self.path == '/batch':
+            self.handle_batch(body)
+        elif self.path == '/stats':
+            self.send(200, json.dumps(stats))
+        else:
+            self.send(*self.answer(self.command, self.path, body))
+
+    def handle_batch(self, body):
+        boundary = self.headers['Content-Type'].split('boundary=')[1]
+        out_boundary = 'batch_standin'
+        out = ''
+        calls = 0
+        for part in body.replace('\r\n', '\n').split('--' + boundary):
+            part = part.strip()
+            if not part or part == '--':
+                continue
+            part_headers, _, request = part.partition('\n\n')
+            content_id = [h.split(':', 1)[1].strip().strip('<>') for h in part_headers.split('\n') if h.lower().startswith('content-id')][0]
+            request_line, _, request = request.partition('\n')
+            _, _, request_body = request.partition('\n\n')
+            method, path = request_line.split(' ')[:2]
+            status, response_body = self.answer(method, path, request_body)
+            calls += 1
+
+            out += '--' + out_boundary + '\r\n'
+            out += 'Content-Type: application/http\r\n'
+            out += 'Content-ID: <response-' + content_id + '>\r\n\r\n'
+            out += 'HTTP/1.1 ' + str(status) + ' OK\r\n'
+            out += 'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+            out += response_body + '\r\n'
+        out += '--' + out_boundary + '--\r\n'
+
+        with lock:
+            stats['batches'] += 1
+            stats['calls'] += calls
+        self.send(200, out, 'multipart/mixed; boundary=' + out_boundary)
+
+    do_GET = do_POST = do_PUT = do_PATCH = handle_call
+
+def write_credentials(path: str, port: int):
+    '''
+    Writes a service account file whose tokens are minted by the stand-in
+    '''
+    key = RSA.generate(2048)
+    credentials = {
+        'type': 'service_account',
+        'project_id': 'standin',
+        'private_key_id': 'standin',
+        'private_key': key.export_key(pkcs=8).decode('utf-8'),
+        'client_email': 'standin@standin.iam.gserviceaccount.com',
+        'client_id': '0',
+        'token_uri': 'http://localhost:' + str(port) + '/token',
+    }
+    with open(path, 'w') as file:
+        json.dump(credentials, file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Google Pay API for Passes')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--credentials', help='write a matching service account file to this path')
+    args = parser.parse_args()
+
+    if args.credentials:
+        write_credentials(args.credentials, args.port)
+
+    StandInHandler.fail_rate = args.fail_rate
+    StandInHandler.latency = args.latency
+    server = ThreadingHTTPServer(('localhost', args.port), StandInHandler)
+    print('Google stand-in listening on http://localhost:' + str(args.port))
+    server.serve_forever()
@@ -0,0 +1,90 @@
+''' scan_bench.py: Compares the reader scan endpoints
+
+Sends the same scans through GET /scan/{pass_hash} (one request per scan),
+POST /scan/batch and the /scan/ws WebSocket, and prints throughput & latency.
+
+Usage:
+    python examples/scan_bench.py --url http://localhost:8000 --scans 2000
+    # use real pass_hashes (each accepted scan rotates its pass in hash mode)
+    python examples/scan_bench.py --db mobil-id.db
+'''
+
+import argparse, asyncio, json, secrets, sqlite3, statistics, threading, time
+
+import requests
+import websockets
+
+def load_hashes(path: str, count: int):
+    if path:
+        with sqlite3.connect(path) as conn:
+            hashes = [row[0] for row in conn.execute('SELECT pass_hash FROM passes LIMIT ?', (count,))]
+        if hashes:
+            return [hashes[index % len(hashes)] for index in range(count)]
+    # unknown hashes measure the lookup path without rotating any pass
+    return [secrets.token_urlsafe(32) for _ in range(count)]
+
+def report(name: str, scans: int, elapsed: float, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(name.ljust(8) + str(round(scans / elapsed)).rjust(8) + ' scans/s' \
+        + '   p50 ' + str(round(statistics.median(latencies) * 1000, 2)) + ' ms' \
+        + '   p99 ' + str(round(p99 * 1000, 2)) + ' ms' \
+        + '   (' + str(len(latencies)) + ' round trips)')
+
+def bench_single(url: str, hashes: list, clients: int):
+    latencies = list()
+    lock = threading.Lock()
+
+    def client(part):
+        session = requests.Session()
+        for pass_hash in part:
+            start = time.perf_counter()
+            session.get(url + '/scan/' + pass_hash, params={'reader': 'bench'})
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(hashes[index::clients],)) for index in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report('single', len(hashes), time.perf_counter() - start, latencies)
+
+def bench_batch(url: str, hashes: list, batch_size: int):
+    session = requests.Session()
+    latencies = list()
+    start = time.perf_counter()
+    for index in range(0, len(hashes), batch_size):
+        scans = [{'hash': pass_hash, 'timestamp': time.time()} for pass_hash in hashes[index:index + batch_size]]
+        sent = time.perf_counter()
+        response = session.post(url + '/scan/batch', params={'reader': 'bench'}, json=scans)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - sent)
+    report('batch', len(hashes), time.perf_counter() - start, latencies)
+
+async def bench_ws(url: str, hashes: list):
+    latencies = list()
+    uri = url.replace('http', 'ws', 1) + '/scan/ws?reader=bench'
+    async with websockets.connect(uri) as websocket:
+        start = time.perf_counter()
+        for index, pass_hash in enumerate(hashes):
+            sent = time.perf_counter()
+            await websocket.send(json.dumps({'id': index, 'hash': pass_hash, 'timestamp': time.time()}))
+            json.loads(await websocket.recv())
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+    report('ws', len(hashes), elapsed, latencies)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the reader scan endpoints')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--scans', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent readers for the single-request endpoint')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--db', help='read pass_hashes from this database instead of sending unknown hashes')
+    args = parser.parse_args()
+
+    bench_single(args.url, load_hashes(args.db, args.scans), args.clients)
+    bench_batch(args.url, load_hashes(args.db, args.scans), args.batch_size)
+    asyncio.run(bench_ws(args.url, load_hashes(args.db, args.scans)))
@@ -290,6 +290,8 @@ class Pass(object):
     def create(self, certificate, key, wwdr_certificate, password, zip_file=None):
         pass_json = self._createPassJson()
         manifest = self._createManifest(pass_json)
+        # identifies the content of the pass, unlike the zip it doesn't change when re-signed
+        self.manifestHash = hashlib.sha1(manifest).hexdigest()
         signature = self._createSignature(manifest, certificate, key, wwdr_certificate, password)
         if not zip_file:
             zip_file = BytesIO()
@@ -0,0 +1,127 @@
+'''
+barcode.py: Barcode messages that readers can verify without a database lookup.
+In 'hmac' mode every pass gets a secret derived from BARCODE_SECRET & its serial_number.
+Google passes show a TOTP code that Google Wallet rotates every BARCODE_PERIOD seconds,
+Apple passes can't rotate on the device so they carry a MAC of the time the pass was built.
+That message is static: after the replay window it is accepted again until BARCODE_MAX_AGE,
+so the nightly rebuild of every pass is what keeps a copied Apple barcode short lived.
+'''
+
+import hmac, hashlib, struct, threading, time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import config, include.crud as crud
+
+# verified barcode, issued is None for rotating (TOTP) barcodes
+Token = namedtuple('Token', ['serial_number', 'issued'])
+
+TOTP_DIGITS = 8
+SEPARATOR = '.'
+
+lock = threading.Lock()
+counts = {'accepted': 0, 'invalid': 0, 'replayed': 0}
+
+def count(name: str):
+    with lock:
+        counts[name] += 1
+
+def stats():
+    with lock:
+        return dict(counts)
+
+def enabled():
+    return config.BARCODE_MODE == 'hmac'
+
+def pass_secret(serial_number: str):
+    '''
+    Per-pass secret, derived so nothing has to be stored
+    '''
+    if not config.BARCODE_SECRET:
+        raise ValueError('BARCODE_SECRET must be set to use hmac barcodes')
+    return hmac.new(config.BARCODE_SECRET.encode('utf-8'), serial_number.encode('utf-8'), hashlib.sha256).digest()
+
+def totp(secret: bytes, counter: int):
+    '''
+    RFC 6238 TOTP with SHA1, the algorithm Google Wallet uses for rotating barcodes
+    '''
+    digest = hmac.new(secret, struct.pack('>Q', counter), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0f
+    code = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7fffffff
+    return str(code % 10 ** TOTP_DIGITS).zfill(TOTP_DIGITS)
+
+def apple_mac(secret: bytes, serial_number: str, issued: int):
+    return hmac.new(secret, (serial_number + SEPARATOR + str(issued)).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+def apple_message(serial_number: str, issued: int = None):
+    '''
+    Static barcode message of an Apple pass built at issued
+    '''
+    issued = int(time.time()) if issued is None else issued
+    return SEPARATOR.join([serial_number, str(issued), apple_mac(pass_secret(serial_number), serial_number, issued)])
+
+def google_totp_details(serial_number: str):
+    '''
+    Rotating barcode parameters shown by Google Wallet, see
+    https://developers.google.com/wallet/reference/rest/v1/RotatingBarcode
+    '''
+    return {
+        'periodMillis': str(config.BARCODE_PERIOD * 1000),
+        'algorithm': 'TOTP_SHA1',
+        'parameters': [{'key': pass_secret(serial_number).hex(), 'valueLength': TOTP_DIGITS}]
+    }
+
+def google_value_pattern(serial_number: str):
+    return serial_number + SEPARATOR + '{totp_value_0}'
+
+def verify(db, message: str, now: float = None, reader: str = None):
+    '''
+    Returns the Token of a valid barcode message, or None
+    A message accepted recently is refused for BARCODE_REPLAY_WINDOW seconds unless
+    the same reader scans it again, so a screenshot or passback can't get in twice
+    '''
+    now = time.time() if now is None else now
+    parts = message.split(SEPARATOR)
+    if len(parts) == 2:
+        token = verify_totp(parts[0], parts[1], now)
+    elif len(parts) == 3:
+        token = verify_apple(parts[0], parts[1], parts[2], now)
+    else:
+        token = None
+    if token is None:
+        count('invalid')
+        return None
+
+    # remembered in the database so every worker refuses the replay
+    scanned = datetime.utcfromtimestamp(now)
+    if not crud.claim_barcode(db, message, reader, scanned, scanned + timedelta(seconds=config.BARCODE_REPLAY_WINDOW)):
+        count('replayed')
+        return None
+    count('accepted')
+    return token
+
+def verify_totp(serial_number: str, code: str, now: float):
+    secret = pass_secret(serial_number)
+    counter = int(now) // config.BARCODE_PERIOD
+    # accept neighbouring periods for clock skew between phone and server
+    for step in range(counter - config.BARCODE_SKEW, counter + config.BARCODE_SKEW + 1):
+        if hmac.compare_digest(totp(secret, step), code):
+            return Token(serial_number, None)
+    return None
+
+def verify_apple(serial_number: str, issued: str, mac: str, now: float):
+    if not issued.isdigit():
+        return None
+    issued = int(issued)
+    if not -config.BARCODE_PERIOD <= now - issued <= config.BARCODE_MAX_AGE:
+        return None
+    if hmac.compare_digest(apple_mac(pass_secret(serial_number), serial_number, issued), mac):
+        return Token(serial_number, issued)
+    return None
+
+def stale(token: Token, now: float = None):
+    '''
+    True if an Apple pass should be rebuilt with a new barcode before it expires
+    '''
+    now = time.time() if now is None else now
+    return token.issued is not None and now - token.issued > config.BARCODE_REISSUE_AGE
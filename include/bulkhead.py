@@ -0,0 +1,98 @@
+'''
+bulkhead.py: Separate thread pools for each class of sync endpoint.
+A surge of registrations blocked on OC, photo downloads & signing fills only its own
+pool, Apple's PassKit calls keep their threads. A saturated pool answers 503 right away
+instead of queueing requests until the client times out.
+'''
+
+import asyncio, functools, inspect, logging
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import Response
+
+import config
+from include.database import SessionLocal
+
+logger = logging.getLogger('app')
+
+class Bulkhead():
+    '''
+    Bounded thread pool with a bounded queue in front of it
+    '''
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # only changed on the event loop, so no lock is needed
+        self.pending = 0
+        self.peak = 0
+        self.counts = {'completed': 0, 'rejected': 0}
+
+    def saturated(self):
+        return self.pending >= self.max_workers + self.max_queue
+
+    async def run(self, func, *args, **kwargs):
+        self.pending += 1
+        self.peak = max(self.peak, self.pending)
+        try:
+            return await asyncio.wrap_future(self.executor.submit(functools.partial(func, *args, **kwargs)))
+        finally:
+            self.pending -= 1
+            self.counts['completed'] += 1
+
+    def stats(self):
+        active = min(self.pending, self.max_workers)
+        return dict(self.counts, active=active, queued=self.pending - active, peak=self.peak, \
+            max_workers=self.max_workers, max_queue=self.max_queue, utilization=round(active / self.max_workers, 2))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+def with_session(func, *args, **kwargs):
+    '''
+    Calls func with a database session opened & closed in the calling thread
+    '''
+    db = SessionLocal()
+    try:
+        return func(*args, db=db, **kwargs)
+    finally:
+        db.close()
+
+def isolate(bulkhead: Bulkhead):
+    '''
+    Runs a sync endpoint in bulkhead, FastAPI still sees the endpoint's own signature
+    A db parameter is left out of that signature and gets a session opened in the bulkhead's
+    thread, a sync dependency would be entered & closed on the shared default thread pool
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        uses_db = 'db' in signature.parameters
+        target = functools.partial(with_session, func) if uses_db else func
+
+        @functools.wraps(func)
+        async def endpoint(*args, **kwargs):
+            if bulkhead.saturated():
+                bulkhead.counts['rejected'] += 1
+                logger.warning(bulkhead.name + ' pool saturated, rejected ' + func.__name__)
+                return Response(status_code=503, headers={'Retry-After': str(config.BULKHEAD_RETRY_AFTER)})
+            return await bulkhead.run(target, *args, **kwargs)
+        if uses_db:
+            endpoint.__signature__ = signature.replace(parameters=[param for name, param in signature.parameters.items() if name != 'db'])
+        return endpoint
+    return decorator
+
+# Apple PassKit web service calls from devices
+device = Bulkhead('device', config.DEVICE_POOL_WORKERS, config.DEVICE_POOL_QUEUE)
+# registration page, blocked on OC, photo downloads & signing
+registration = Bulkhead('registration', config.REGISTRATION_POOL_WORKERS, config.REGISTRATION_POOL_QUEUE)
+# reader requests
+reader = Bulkhead('reader', config.READER_POOL_WORKERS, config.READER_POOL_QUEUE)
+
+def stats():
+    return {'device': device.stats(), 'registration': registration.stats(), 'reader': reader.stats()}
+
+def shutdown():
+    device.shutdown()
+    registration.shutdown()
+    reader.shutdown()
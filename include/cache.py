@@ -0,0 +1,67 @@
+'''
+cache.py: Bounded, thread-safe in-process caches
+'''
+
+import threading, time
+from collections import OrderedDict
+
+class LRUCache():
+    '''
+    Least recently used cache with an optional time-to-live per entry
+    '''
+    def __init__(self, maxsize: int, ttl: float = None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict # called with (key, value) of entries dropped for size or age
+        self.data = OrderedDict() # key -> (expires, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= time.monotonic()):
+                self.data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                # expired
+                del self.data[key]
+            self.misses += 1
+        if entry is not None:
+            self.evicted([(key, entry)])
+        return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        evicted = list()
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                # evict least recently used
+                evicted.append(self.data.popitem(last=False))
+        self.evicted(evicted)
+
+    def evicted(self, entries: list):
+        # outside of the lock, so the callback may use the cache
+        if self.on_evict:
+            for key, entry in entries:
+                self.on_evict(key, entry[1])
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
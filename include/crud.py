@@ -3,27 +3,73 @@ crud.py: Reusable functions to interact with the data in the database.
 CRUD comes from: Create, Read, Update, and Delete.
 '''
 
-import secrets
+import secrets, hmac
+from collections import namedtuple
 from datetime import datetime
 
+from sqlalchemy import func, insert, bindparam, or_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.orm import Session, load_only
 
-import include.utils as utils, config
-from include.schemas import User, Pkpass, JWT
-from include.models import Device, Pass, Registration
+import include.utils as utils, include.passindex as passindex, include.devicelists as devicelists, include.storage as storage, config
+from include.schemas import User
+from include.models import Device, Pass, Registration, GoogleClass, GoogleObject, PassChange, DeviceChange, ScanEvent, ScanRollup, ServerSecret, SeenBarcode, RegistrationJob, ReleasedBlob
+from include.cache import LRUCache
+
+# hot pass rows served without touching the database
+PassRow = namedtuple('PassRow', ['serial_number', 'auth_token', 'last_update', 'etag', 'built_at', 'pkpass_key'])
+pass_rows = LRUCache(config.PASS_CACHE_SIZE, config.PASS_CACHE_TTL)
+# seq of the latest pass_changes row of a pass (0 if it never changed) & its last_update
+PassVersion = namedtuple('PassVersion', ['seq', 'last_update'])
 
 def get_device(db: Session, device_id: str):
     return db.query(Device).filter(Device.device_id==device_id).first()
 
 def get_pass(db: Session, serial_number: str, auth_token: str = None):
     db_pass = db.query(Pass).filter(Pass.serial_number==serial_number).first()
-    if auth_token:
-        db_pass = db.query(Pass).filter(Pass.serial_number==serial_number,Pass.auth_token==auth_token).first()
+    if db_pass and auth_token is not None and not authorized(db_pass.auth_token, auth_token):
+        db_pass = None
     return db_pass
 
+def get_pass_row(db: Session, serial_number: str):
+    '''
+    Columns needed to authorize a device & answer conditional requests, cached in memory
+    '''
+    # drop rows other workers changed
+    passindex.index.sync(db)
+    row = pass_rows.get(serial_number)
+    if row is None:
+        row = db.query(Pass.serial_number, Pass.auth_token, Pass.last_update, Pass.etag, Pass.built_at, Pass.pkpass_key) \
+            .filter(Pass.serial_number==serial_number).first()
+        if row is None:
+            return None
+        row = PassRow(*row)
+        pass_rows.set(serial_number, row)
+    return row
+
+def get_authorized_pass(db: Session, serial_number: str, auth_token: str):
+    row = get_pass_row(db, serial_number)
+    if row and authorized(row.auth_token, auth_token):
+        return row
+
+def authorized(pass_token: str, auth_token: str):
+    # constant-time comparison so the token can't be guessed by timing
+    return bool(pass_token) and hmac.compare_digest(pass_token.encode('utf-8'), str(auth_token).encode('utf-8'))
+
 def get_pass_by_hash(db: Session, pass_hash: str):
     return db.query(Pass).filter(Pass.pass_hash==pass_hash).first()
 
+def get_pass_hashes(db: Session):
+    return db.query(Pass.pass_hash, Pass.serial_number).all()
+
+def get_change_version(db: Session):
+    return db.query(func.max(PassChange.seq)).scalar() or 0
+
+def get_changes_since(db: Session, seq: int):
+    return db.query(PassChange.seq, PassChange.serial_number, PassChange.pass_hash) \
+        .filter(PassChange.seq > seq).order_by(PassChange.seq).all()
+
 def get_all_passes(db: Session):
     serial_numbers = list()
     
@@ -34,40 +80,48 @@ def get_all_passes(db: Session):
     return serial_numbers
 
 def get_pass_list_by_device(db: Session, device_id: str, passesUpdatedSince: str = None):
-    serial_numbers = list()
+    '''
+    Returns the update tag of the device & the serial_numbers of its passes changed after passesUpdatedSince
+    '''
+    # serial_number -> PassVersion of every pass associated with device, cached in memory
+    passes = devicelists.lists.get(db, device_id)
 
-    registrations = get_registrations_by_device(db, device_id)
+    # latest change of every pass associated with device,
+    # exact unlike last_update which only has whole seconds
+    last_updated = max((version.seq for version in passes.values()), default=0)
 
-    # covert given string to datetime obj for comparisons
-    if passesUpdatedSince:
+    serial_numbers = list(passes)
+    if passesUpdatedSince and str(passesUpdatedSince).isdigit():
+        # If passesUpdatedSince tag was sent in get request
+        # only get passes changed after the tag
+        updated_since = int(passesUpdatedSince)
+        serial_numbers = [serial_number for serial_number, version in passes.items() if version.seq > updated_since]
+    elif passesUpdatedSince:
+        # tag handed out as a last_update before change seqs were used
         updated_since = datetime.strptime(str(passesUpdatedSince), '%Y-%m-%d %H:%M:%S')
+        serial_numbers = [serial_number for serial_number, version in passes.items() \
+            if version.last_update and version.last_update > updated_since]
 
-    last_updated = datetime.min
-    for curr_pass in registrations:
-        curr_pass_last_update = get_pass(db, curr_pass.serial_number).last_update
-        if passesUpdatedSince:
-            # If passesUpdatedSince tag was sent in get request
-            # only get passes updated after the tag
-            if updated_since < curr_pass_last_update:
-                serial_numbers.append(curr_pass.serial_number)
-        else:
-            # Get all pass serial_numbers associated with device
-            serial_numbers.append(curr_pass.serial_number)
-        if last_updated < curr_pass_last_update:
-                last_updated = curr_pass_last_update
-    
     return last_updated, serial_numbers
 
+def get_device_passes(db: Session, device_id: str):
+    rows = db.query(Pass.serial_number, Pass.last_update, PassChange.seq) \
+        .join(Registration, Registration.serial_number==Pass.serial_number) \
+        .outerjoin(PassChange, PassChange.serial_number==Pass.serial_number) \
+        .filter(Registration.device_id==device_id)
+    return {row.serial_number: PassVersion(row.seq or 0, row.last_update) for row in rows}
+
 def get_device_list_by_pass(db: Session, serial_number: str):
-    push_tokens = list()
+    devices = db.query(Device.push_token).join(Registration, Registration.device_id==Device.device_id) \
+        .filter(Registration.serial_number==serial_number)
 
-    devices = get_registrations_by_pass(db, serial_number)
+    return [device.push_token for device in devices]
 
-    for curr_device in devices:
-        device = get_device(db, curr_device.device_id)
-        push_tokens.append(device.push_token)
-    
-    return push_tokens
+def get_google_class(db: Session, class_id: str):
+    return db.query(GoogleClass).filter(GoogleClass.class_id==class_id).first()
+
+def get_google_object(db: Session, serial_number: str):
+    return db.query(GoogleObject).filter(GoogleObject.serial_number==serial_number).first()
 
 def get_registration(db: Session, device_id: str, serial_number: str):
     return db.query(Registration).filter(Registration.device_id==device_id,Registration.serial_number==serial_number).first()
@@ -81,22 +135,11 @@ def get_registrations_by_device(db: Session, device_id: str):
 def get_registrations_by_pass(db: Session, serial_number: str):
     return db.query(Registration).filter(Registration.serial_number==serial_number).all()
 
-def add_device(db: Session, device_id: str, push_token: str):
-    device = Device()
-    device.device_id = device_id
-    device.push_token = push_token
-
-    db.add(device)
-    db.commit() # commit new registation to database
-    db.refresh(device)
-    return device
-
 def add_pass(db: Session, user: User):
     db_pass = Pass()
     db_pass.pass_type = config.PASS_TYPE_IDENTIFIER
     db_pass.serial_number = user.id
     db_pass.last_update = datetime.utcnow().replace(microsecond=0)
-    db_pass.pass_hash = utils.unique_pass_hash(db, 32)
     db_pass.auth_token = secrets.token_urlsafe(32)
     db_pass.name = user.name
     db_pass.photo_URL = user.photo_URL
@@ -108,54 +151,328 @@ def add_pass(db: Session, user: User):
     db_pass.print_balance = user.print_balance
     db_pass.mailbox = user.mailbox
 
-    db.add(db_pass)
-    db.commit()
+    for attempt in range(config.PASS_HASH_RETRIES + 1):
+        db_pass.pass_hash = utils.new_pass_hash()
+        db.add(db_pass)
+        try:
+            # the pass row first, so the change log lock is only held until the commit
+            db.flush()
+            record_change(db, db_pass.serial_number, db_pass.pass_hash)
+            db.commit()
+            break
+        except IntegrityError as err:
+            db.rollback()
+            if not hash_conflict(err) or attempt == config.PASS_HASH_RETRIES:
+                raise
     db.refresh(db_pass)
+    passindex.index.apply(db_pass.serial_number, db_pass.pass_hash)
     return db_pass
 
-def add_registration(db: Session, device_id: str, serial_number: str):
-    registration = Registration()
-    registration.device_id = device_id
-    registration.serial_number = serial_number
+def register_device(db: Session, device_id: str, push_token: str, serial_number: str):
+    '''
+    Upserts the device & its registration for a pass in one transaction, returns True if the registration is new
+    '''
+    device = upsert(db, Device).values(device_id=device_id, push_token=push_token)
+    # a restored device registers again with its new push token
+    db.execute(device.on_conflict_do_update(index_elements=['device_id'], set_={'push_token': device.excluded.push_token}))
+    registration = upsert(db, Registration).values(device_id=device_id, serial_number=serial_number)
+    created = db.execute(registration.on_conflict_do_nothing(index_elements=['device_id', 'serial_number'])).rowcount == 1
+    if created:
+        record_device_change(db, device_id)
+    db.commit()
+    if created:
+        devicelists.lists.device_changed(device_id)
+    return created
 
-    db.add(registration)
-    db.commit() # commit new registation to database
-    db.refresh(registration)
-    return registration
+def set_google_class(db: Session, class_id: str, definition_hash: str):
+    google_class = get_google_class(db, class_id)
+    if not google_class:
+        google_class = GoogleClass()
+        google_class.class_id = class_id
+        db.add(google_class)
+    google_class.definition_hash = definition_hash
+    google_class.last_sync = datetime.utcnow().replace(microsecond=0)
 
-def delete_device(db: Session, device_id: str):
-    device = db.query(Device).filter(Device.device_id==device_id).first()
-    db.delete(device)
     db.commit()
+    return google_class
+
+def set_google_object(db: Session, serial_number: str, object_id: str, fingerprint: str, commit: bool = True):
+    google_object = get_google_object(db, serial_number)
+    if not google_object:
+        google_object = GoogleObject()
+        google_object.serial_number = serial_number
+        db.add(google_object)
+    google_object.object_id = object_id
+    google_object.fingerprint = fingerprint
+    google_object.last_sync = datetime.utcnow().replace(microsecond=0)
+
+    if commit:
+        db.commit()
+    return google_object
 
-def delete_registration(db: Session, device_id: str, serial_number: str):
-    registration = db.query(Registration).filter(Registration.device_id==device_id, Registration.serial_number==serial_number).first()
-    db.delete(registration)
+def record_changes(db: Session, changes: list):
+    '''
+    Logs many (serial_number, pass_hash) changes with one delete & one executemany insert
+    '''
+    if not changes:
+        return
+    lock_changes(db, PassChange)
+    db.query(PassChange).filter(PassChange.serial_number.in_([serial_number for serial_number, pass_hash in changes])) \
+        .delete(synchronize_session=False)
+    changed_at = datetime.utcnow()
+    db.execute(insert(PassChange), [{'serial_number': serial_number, 'pass_hash': pass_hash, 'changed_at': changed_at} \
+        for serial_number, pass_hash in changes])
+
+def record_change(db: Session, serial_number: str, pass_hash: str):
+    '''
+    Logs a pass change for other workers, committed with the change itself
+    '''
+    record_changes(db, [(serial_number, pass_hash)])
+
+def get_device_change_version(db: Session):
+    return db.query(func.max(DeviceChange.seq)).scalar() or 0
+
+def get_device_changes_since(db: Session, seq: int):
+    return db.query(DeviceChange.seq, DeviceChange.device_id) \
+        .filter(DeviceChange.seq > seq).order_by(DeviceChange.seq).all()
+
+def record_device_change(db: Session, device_id: str):
+    '''
+    Logs a change to the registrations of a device for other workers, committed with the change itself
+    '''
+    lock_changes(db, DeviceChange)
+    db.query(DeviceChange).filter(DeviceChange.device_id==device_id).delete(synchronize_session=False)
+    db.execute(insert(DeviceChange), [{'device_id': device_id, 'changed_at': datetime.utcnow()}])
+
+def lock_changes(db: Session, model):
+    '''
+    Makes seqs become visible in order, workers & devices only read changes above the last seq they saw
+    '''
+    # SQLite has one writer at a time, PostgreSQL draws a seq at insert & could commit
+    # a lower one after a higher one, so writers of the change log wait for each other until commit
+    if db.get_bind().dialect.name == 'postgresql':
+        db.execute(text('LOCK TABLE ' + model.__tablename__ + ' IN EXCLUSIVE MODE'))
+
+def get_shared_secret(db: Session, name: str):
+    '''
+    Secret every worker agrees on, the first worker to ask generates it
+    '''
+    secret = upsert(db, ServerSecret).values(name=name, value=secrets.token_hex(32))
+    db.execute(secret.on_conflict_do_nothing(index_elements=['name']))
     db.commit()
+    return db.query(ServerSecret.value).filter(ServerSecret.name==name).scalar()
 
-def update_db_pass(db: Session, user: User):
-    db_pass = db.query(Pass).filter(Pass.serial_number==user.id).first()
-    db_pass.pass_type = config.PASS_TYPE_IDENTIFIER
-    db_pass.serial_number = user.id
-    db_pass.last_update = datetime.utcnow().replace(microsecond=0)
-    db_pass.pass_hash = utils.unique_pass_hash(db, 32)
-    db_pass.name = user.name
-    db_pass.photo_URL = user.photo_URL
-    db_pass.eagle_bucks = user.eagle_bucks
-    db_pass.meals_remaining = user.meals_remaining
-    db_pass.kudos_earned = user.kudos_earned
-    db_pass.kudos_required = user.kudos_required
-    db_pass.id_pin = user.id_pin
-    db_pass.print_balance = user.print_balance
-    db_pass.mailbox = user.mailbox
+def finish_registration_job(db: Session, job_id: str, state: str):
+    '''
+    Records how a registration job ended
+    '''
+    finished = upsert(db, RegistrationJob).values(job_id=job_id, state=state, finished_at=datetime.utcnow())
+    db.execute(finished.on_conflict_do_update(index_elements=['job_id'], \
+        set_={'state': finished.excluded.state, 'finished_at': finished.excluded.finished_at}))
+    db.commit()
+
+def get_registration_job_state(db: Session, job_id: str):
+    return db.query(RegistrationJob.state).filter(RegistrationJob.job_id==job_id).scalar()
+
+def purge_registration_jobs(db: Session, before: datetime):
+    '''
+    Deletes registration jobs that finished before before
+    '''
+    deleted = db.query(RegistrationJob).filter(RegistrationJob.finished_at < before).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def claim_barcode(db: Session, message: str, reader: str, now: datetime, expires_at: datetime):
+    '''
+    Marks a barcode message as scanned until expires_at, returns False if it was
+    already scanned by another reader and hasn't expired, shared by every worker
+    '''
+    claim = upsert(db, SeenBarcode).values(message=message, reader=reader, expires_at=expires_at)
+    claim = claim.on_conflict_do_update(
+        index_elements=['message'],
+        set_={'reader': claim.excluded.reader, 'expires_at': claim.excluded.expires_at},
+        # a retry of the same reader is accepted, readers without a name can't retry
+        where=or_(SeenBarcode.expires_at < now, SeenBarcode.reader == claim.excluded.reader))
+    claimed = db.execute(claim).rowcount == 1
+    db.commit()
+    return claimed
+
+def purge_seen_barcodes(db: Session, now: datetime):
+    '''
+    Deletes barcode messages whose replay window has passed
+    '''
+    deleted = db.query(SeenBarcode).filter(SeenBarcode.expires_at < now).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def upsert(db: Session, model):
+    '''
+    INSERT statement of the session's dialect that supports ON CONFLICT
+    '''
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def add_scan_events(db: Session, events: list):
+    '''
+    Appends scan events & adds them to their rollups in one transaction
+    '''
+    rollups = dict()
+    for event in events:
+        key = (event['reader'], event['bucket'])
+        scans, accepted = rollups.get(key, (0, 0))
+        rollups[key] = (scans + 1, accepted + int(event['accepted']))
+
+    # executemany, one statement for the whole batch
+    db.execute(insert(ScanEvent), [{'scanned_at': event['scanned_at'], 'reader': event['reader'], \
+        'serial_number': event['serial_number'], 'accepted': event['accepted']} for event in events])
+
+    statement = upsert(db, ScanRollup)
+    statement = statement.on_conflict_do_update(index_elements=['reader', 'bucket'], \
+        set_={'scans': ScanRollup.scans + statement.excluded.scans, 'accepted': ScanRollup.accepted + statement.excluded.accepted})
+    db.execute(statement, [{'reader': reader, 'bucket': bucket, 'scans': scans, 'accepted': accepted} \
+        for (reader, bucket), (scans, accepted) in rollups.items()])
+    db.commit()
+
+def get_scan_rollups(db: Session, reader: str = None, since: datetime = None, until: datetime = None):
+    query = db.query(ScanRollup.reader, ScanRollup.bucket, ScanRollup.scans, ScanRollup.accepted)
+    if reader is not None:
+        query = query.filter(ScanRollup.reader==reader)
+    if since is not None:
+        query = query.filter(ScanRollup.bucket>=since)
+    if until is not None:
+        query = query.filter(ScanRollup.bucket<until)
+    return query.order_by(ScanRollup.bucket, ScanRollup.reader).all()
+
+def delete_google_object(db: Session, serial_number: str):
+    db.query(GoogleObject).filter(GoogleObject.serial_number==serial_number).delete()
+    db.commit()
+
+def unregister_device(db: Session, device_id: str, serial_number: str):
+    '''
+    Deletes a registration & the device once it has none left in one transaction
+    '''
+    deleted = db.query(Registration).filter(Registration.device_id==device_id, Registration.serial_number==serial_number) \
+        .delete(synchronize_session=False)
+    # lock the device first, so a registration committed meanwhile is seen & the device kept
+    db.query(Device.device_id).filter(Device.device_id==device_id).with_for_update().first()
+    db.query(Device).filter(Device.device_id==device_id, \
+        ~db.query(Registration).filter(Registration.device_id==device_id).exists()) \
+        .delete(synchronize_session=False)
+    if deleted:
+        # last, the change log lock is held until the commit
+        record_device_change(db, device_id)
     db.commit()
-    Pkpass(db, user.id)
-    JWT(db, user.id)
+    if deleted:
+        devicelists.lists.device_changed(device_id)
+
+# pass columns copied from a User on every update
+USER_FIELDS = ['name', 'photo_URL', 'eagle_bucks', 'meals_remaining', 'kudos_earned', 'kudos_required', 'id_pin', 'print_balance', 'mailbox']
+
+def update_db_pass(db: Session, user: User):
+    bulk_update_passes(db, [user])
 
 def update_hash(db: Session, serial_number: str):
-    db_pass = db.query(Pass).filter(Pass.serial_number==serial_number).first()
-    db_pass.pass_hash = utils.unique_pass_hash(db, 32)
-    db_pass.last_update = datetime.utcnow().replace(microsecond=0)
+    bulk_rotate_hashes(db, [serial_number])
+
+def bulk_update_passes(db: Session, users: list):
+    '''
+    Updates the passes of users & rotates their hashes in one statement & commit
+    '''
+    rows = [dict({field: getattr(user, field) for field in USER_FIELDS}, _serial=user.id, pass_type=config.PASS_TYPE_IDENTIFIER) for user in users]
+    write_pass_rows(db, rows)
+
+def bulk_rotate_hashes(db: Session, serial_numbers: list):
+    '''
+    Rotates the hashes of passes in one statement & commit
+    '''
+    write_pass_rows(db, [{'_serial': serial_number} for serial_number in serial_numbers])
+
+def write_pass_rows(db: Session, rows: list):
+    '''
+    Applies rows keyed by _serial with a new pass_hash & last_update each,
+    as one executemany UPDATE, retried with new hashes if one is already taken
+    '''
+    if not rows:
+        return
+    table = Pass.__table__
+    # columns to SET are taken from the keys of the rows
+    statement = table.update().where(table.c.serial_number==bindparam('_serial'))
+    for attempt in range(config.PASS_HASH_RETRIES + 1):
+        last_update = datetime.utcnow().replace(microsecond=0)
+        for row in rows:
+            row['pass_hash'] = utils.new_pass_hash()
+            row['last_update'] = last_update
+        try:
+            updated = db.execute(statement, rows).rowcount
+            if updated != len(rows):
+                # passes deleted meanwhile have no change to record
+                existing = {row.serial_number for row in db.query(Pass.serial_number) \
+                    .filter(Pass.serial_number.in_([row['_serial'] for row in rows]))}
+                rows = [row for row in rows if row['_serial'] in existing]
+            record_changes(db, [(row['_serial'], row['pass_hash']) for row in rows])
+            db.commit()
+            break
+        except IntegrityError as err:
+            db.rollback()
+            if not hash_conflict(err) or attempt == config.PASS_HASH_RETRIES:
+                raise
+
+    for row in rows:
+        pass_rows.pop(row['_serial'])
+        passindex.index.apply(row['_serial'], row['pass_hash'])
+        devicelists.lists.pass_changed(row['_serial'])
+
+def set_pkpass(db: Session, serial_number: str, pkpass_key: str, etag: str, built_at: datetime):
+    pass_hash, old_key = db.query(Pass.pass_hash, Pass.pkpass_key).filter(Pass.serial_number==serial_number).one()
+    db.query(Pass).filter(Pass.serial_number==serial_number) \
+        .update({'pkpass_key': pkpass_key, 'etag': etag, 'built_at': built_at}, synchronize_session=False)
+    # other workers drop their cached row
+    record_change(db, serial_number, pass_hash)
+    db.commit()
+    pass_rows.pop(serial_number)
+    # devices are told about the rebuilt pass
+    devicelists.lists.pass_changed(serial_number)
+    if old_key != pkpass_key:
+        release_blob(db, old_key)
+
+def get_hero_key(db: Session, serial_number: str):
+    return db.query(Pass.hero_key).filter(Pass.serial_number==serial_number).scalar()
+
+def set_hero_key(db: Session, serial_number: str, hero_key: str):
+    old_key = get_hero_key(db, serial_number)
+    db.query(Pass).filter(Pass.serial_number==serial_number).update({'hero_key': hero_key}, synchronize_session=False)
     db.commit()
-    Pkpass(db, serial_number)
-    JWT(db, serial_number)
+    if old_key != hero_key:
+        release_blob(db, old_key)
+
+def release_blob(db: Session, key: str):
+    '''
+    Marks a superseded blob for the sweep, it isn't deleted right away because another
+    request may have put the same content & not committed its reference yet
+    '''
+    if not key:
+        return
+    released = upsert(db, ReleasedBlob).values(key=key, released_at=datetime.utcnow())
+    db.execute(released.on_conflict_do_update(index_elements=['key'], set_={'released_at': released.excluded.released_at}))
+    db.commit()
+
+def sweep_blobs(db: Session, before: datetime):
+    '''
+    Deletes blobs released before before that no pass references, returns how many
+    '''
+    deleted = 0
+    keys = db.query(ReleasedBlob.key).filter(ReleasedBlob.released_at < before).all()
+    for (key,) in keys:
+        if not db.query(Pass.serial_number).filter(or_(Pass.pkpass_key==key, Pass.hero_key==key)).first():
+            storage.store.delete(key)
+            deleted += 1
+        # released again meanwhile, the next sweep looks at it
+        db.query(ReleasedBlob).filter(ReleasedBlob.key==key, ReleasedBlob.released_at < before).delete(synchronize_session=False)
+        db.commit()
+    return deleted
+
+def hash_conflict(err: IntegrityError):
+    # the unique index on pass_hash rejected a new hash
+    return 'pass_hash' in str(err.orig)
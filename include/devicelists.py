@@ -0,0 +1,109 @@
+'''
+devicelists.py: In-memory answers to the device registrations poll.
+After every push each device asks which of its passes changed. The serial_numbers
+& change seqs of a device's passes are kept until one of those passes changes
+(pass_changes, through the scan index sync) or the device's registrations change
+(device_changes), so the poll storm after a mass push is served from memory.
+'''
+
+import threading, time
+
+import config, include.crud as crud, include.passindex as passindex
+from include.cache import LRUCache
+
+class DeviceLists():
+    '''
+    Maps device_id -> {serial_number: PassVersion} of the passes registered on the device
+    '''
+    def __init__(self):
+        self.entries = LRUCache(config.DEVICE_CACHE_SIZE, on_evict=self.forget)
+        self.devices = {} # serial_number -> device_ids that have the pass in a cached entry
+        self.generation = 0 # bumped by every invalidation, so a list read meanwhile isn't cached
+        self.version = None # last device_changes seq applied, None until synced
+        self.synced = 0.0
+        self.lock = threading.RLock() # evictions while caching a list take it again
+        self.sync_lock = threading.Lock()
+        self.counts = {'db_reads': 0, 'pass_invalidations': 0, 'device_invalidations': 0, 'syncs': 0}
+
+    def get(self, db, device_id: str):
+        '''
+        Returns {serial_number: PassVersion} of the passes registered on device_id
+        '''
+        passindex.index.sync(db)
+        self.sync(db)
+        passes = self.entries.get(device_id)
+        if passes is not None:
+            return passes
+
+        generation = self.generation
+        self.counts['db_reads'] += 1
+        passes = crud.get_device_passes(db, device_id)
+        with self.lock:
+            if generation == self.generation:
+                self.entries.set(device_id, passes)
+                for serial_number in passes:
+                    self.devices.setdefault(serial_number, set()).add(device_id)
+        return passes
+
+    def sync(self, db):
+        '''
+        Applies registration changes other workers logged since the last sync
+        '''
+        if self.version is None:
+            # nothing is cached yet, older changes don't matter
+            self.version = crud.get_device_change_version(db)
+            self.synced = time.monotonic()
+            return
+        # registrations change at the same pace as pass hashes are synced
+        if time.monotonic() - self.synced < config.SCAN_INDEX_SYNC_INTERVAL:
+            return
+        if not self.sync_lock.acquire(blocking=False):
+            # another thread is already syncing
+            return
+        try:
+            self.synced = time.monotonic()
+            self.counts['syncs'] += 1
+            for change in crud.get_device_changes_since(db, self.version):
+                self.device_changed(change.device_id)
+                self.version = change.seq
+        finally:
+            self.sync_lock.release()
+
+    def pass_changed(self, serial_number: str):
+        '''
+        Drops the lists of every device that has the pass
+        '''
+        with self.lock:
+            self.generation += 1
+            device_ids = self.devices.pop(serial_number, ())
+        for device_id in device_ids:
+            self.forget(device_id, self.entries.pop(device_id))
+        self.counts['pass_invalidations'] += 1
+
+    def device_changed(self, device_id: str):
+        '''
+        Drops the list of a device whose registrations changed
+        '''
+        with self.lock:
+            self.generation += 1
+        self.forget(device_id, self.entries.pop(device_id))
+        self.counts['device_invalidations'] += 1
+
+    def forget(self, device_id: str, passes: dict):
+        '''
+        Removes a device whose list left the cache from the passes it had
+        '''
+        with self.lock:
+            for serial_number in passes or ():
+                device_ids = self.devices.get(serial_number)
+                if device_ids is not None:
+                    device_ids.discard(device_id)
+                    if not device_ids:
+                        del self.devices[serial_number]
+
+    def stats(self):
+        return dict(self.counts, **self.entries.stats(), passes=len(self.devices), version=self.version)
+
+lists = DeviceLists()
+# passes changed by other workers
+passindex.index.listeners.append(lists.pass_changed)
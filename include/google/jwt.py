@@ -1,4 +1,4 @@
-import time
+import threading, time
 
 # for jwt signing. see https://google-auth.readthedocs.io/en/latest/reference/google.auth.jwt.html#module-google.auth.jwt
 from google.auth import crypt as cryptGoogle
@@ -19,6 +19,19 @@ import config
 #
 #############################
 
+# RSA signer loaded once per process, the key file is read and parsed on first use
+_signer = None
+_signerLock = threading.Lock()
+
+def getSigner():
+  global _signer
+
+  with _signerLock:
+    if _signer is None:
+      _signer = cryptGoogle.RSASigner.from_service_account_file(config.SERVICE_ACCOUNT_FILE)
+
+  return _signer
+
 class googlePassJwt:
   def __init__(self):
     self.audience = config.AUDIENCE
@@ -29,7 +42,7 @@ class googlePassJwt:
     self.payload = {}
     
     # signer for RSA-SHA256. Uses same private key used in OAuth2.0
-    self.signer = cryptGoogle.RSASigner.from_service_account_file(config.SERVICE_ACCOUNT_FILE)
+    self.signer = getSigner()
 
   def addLoyaltyClass(self, resourcePayload):
     self.payload.setdefault('loyaltyClasses',[])
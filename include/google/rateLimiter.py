@@ -0,0 +1,51 @@
+import threading, time
+
+#############################
+#
+# Token bucket shared by every call to the Google Pay API for Passes
+#
+# Tokens refill at the current rate up to the burst size. A caller takes its tokens
+# right away and sleeps off any debt, so callers are served in order even when one
+# of them (a batch request) needs more tokens than the bucket holds.
+#
+# The rate adapts to the quota: it is halved whenever Google throttles us and
+# creeps back up to the configured maximum while calls succeed.
+#
+#############################
+class TokenBucket:
+  def __init__(self, rate, burst, minRate=1.0):
+    self.maxRate = float(rate)
+    self.minRate = min(float(minRate), self.maxRate)
+    self.rate = self.maxRate
+    self.burst = float(burst)
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def acquire(self, tokens=1):
+    # returns the seconds spent waiting for the tokens
+    with self.lock:
+      self.refill()
+      self.tokens -= tokens
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    if wait:
+      time.sleep(wait)
+    return wait
+
+  def throttled(self):
+    # multiplicative decrease when Google answers 429
+    with self.lock:
+      self.refill()
+      self.rate = max(self.minRate, self.rate / 2)
+
+  def succeeded(self):
+    # additive increase back towards the configured rate
+    with self.lock:
+      self.refill()
+      self.rate = min(self.maxRate, self.rate + self.maxRate / 100)
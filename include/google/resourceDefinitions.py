@@ -1,4 +1,5 @@
 import config
+import include.barcode as barcode
 
 def makeLoyaltyClassResource(classId):
   # Define the resource representation of the Class
@@ -82,7 +83,7 @@ def makeLoyaltyClassResource(classId):
  
   return payload
 
-def makeLoyaltyObjectResource(classId, objectId, user):
+def makeLoyaltyObjectResource(classId, objectId, user, heroImageVersion=None):
   # Define the resource representation of the Object
   # values should be from your DB/services; here we hardcode information
 
@@ -99,15 +100,10 @@ def makeLoyaltyObjectResource(classId, objectId, user):
     # optional
     "accountId": user.serial_number,
     "accountName": user.name,
-    "barcode": {
-        "alternateText": user.serial_number,
-        "type": 'QR_CODE',
-        "value": user.pass_hash
-    },
         "heroImage": {
             "kind": "walletobjects#image",
             "sourceUri": {
-                "uri": config.WEB_SERVICE_URL + "/static/heroImg/" + user.serial_number + ".png",
+                "uri": makeHeroImageUri(user.serial_number, heroImageVersion),
                 "image":  'asdasdas',
                 "label": "heroImg"
             }
@@ -176,4 +172,35 @@ def makeLoyaltyObjectResource(classId, objectId, user):
     }]  
         
   }
+  payload.update(makeBarcode(user))
   return payload
+
+def makeBarcode(user):
+  # hmac mode lets Google Wallet rotate a TOTP code that readers verify statelessly,
+  # otherwise the pass shows its pass_hash, rotated by the server after every scan
+  if barcode.enabled():
+    return {
+      "rotatingBarcode": {
+        "alternateText": user.serial_number,
+        "type": "QR_CODE",
+        "valuePattern": barcode.google_value_pattern(user.serial_number),
+        "totpDetails": barcode.google_totp_details(user.serial_number)
+      }
+    }
+
+  return {
+    "barcode": {
+      "alternateText": user.serial_number,
+      "type": "QR_CODE",
+      "value": user.pass_hash
+    }
+  }
+
+def makeHeroImageUri(serialNumber, heroImageVersion=None):
+  # the version changes whenever the rendered image does,
+  # so Google fetches the new image instead of its cached copy
+  uri = config.WEB_SERVICE_URL + "/static/heroImg/" + serialNumber + ".png"
+  if heroImageVersion:
+    uri += "?v=" + heroImageVersion
+
+  return uri
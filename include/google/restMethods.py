@@ -1,11 +1,35 @@
+import json, random, threading, time, uuid
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import requests
 # For OAuth 2.0
 from google.oauth2 import service_account # pip install google-auth
 # HTTP client For making REST API call with google-auth package
-from google.auth.transport.requests import AuthorizedSession
+from google.auth.transport.requests import AuthorizedSession, Request
 
 # constants from config file
 import config
 import include.google.services as services
+from include.google.rateLimiter import TokenBucket
+
+WALLET_OBJECTS_PATH = '/walletobjects/v1'
+WALLET_OBJECTS_URI = config.GOOGLE_API_URI + WALLET_OBJECTS_PATH
+BATCH_URI = config.GOOGLE_API_URI + '/batch'
+# refresh the OAuth access token this long before Google expires it
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# process-wide authorized session, shared by every REST call
+_authedSession = None
+_authedSessionLock = threading.Lock()
+# transport used only for minting new OAuth access tokens
+_tokenRequest = Request()
+
+# every Google Pay API call of this process draws from this bucket,
+# the quota is split evenly between the server's worker processes
+_rateLimiter = TokenBucket(config.GOOGLE_RATE_LIMIT / config.WORKERS, max(1, config.GOOGLE_RATE_BURST // config.WORKERS))
+_stats = {'requests': 0, 'throttled': 0, 'server_errors': 0, 'retries': 0, 'failures': 0, 'wait_seconds': 0.0}
+_statsLock = threading.Lock()
 
 ###############################
 #
@@ -24,6 +48,118 @@ def makeOauthCredential():
 
   return credentials
 
+###############################
+#
+# Get the process-wide authorized http client
+#
+# The service account file is read once. The OAuth access token is only re-minted
+# when it is missing or about to expire, and keep-alive connections to
+# walletobjects.googleapis.com are pooled across calls and threads.
+#
+# @return AuthorizedSession authed_session - shared authorized http client
+#
+###############################
+def getAuthorizedSession():
+  global _authedSession
+
+  with _authedSessionLock:
+    if _authedSession is None:
+      _authedSession = AuthorizedSession(makeOauthCredential())
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.GOOGLE_POOL_SIZE)
+      _authedSession.mount('https://', adapter)
+
+    # refresh under the lock so concurrent callers never mint duplicate tokens
+    credentials = _authedSession.credentials
+    if not credentials.valid or credentials.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+      credentials.refresh(_tokenRequest)
+
+  return _authedSession
+
+###############################
+#
+# Send a request within the rate limit, retrying when Google is throttling or failing
+#
+# 429 and 5xx responses (and dropped connections) are retried up to
+# config.GOOGLE_MAX_RETRIES times. The wait honours Retry-After when Google sends it,
+# otherwise it backs off exponentially with jitter.
+#
+# @param Function method - bound method of the authorized session (post, get, ...)
+# @param String url - REST API endpoint
+# @param Integer tokens - optional. Quota used by the request
+# @return requests.Response response - response from REST call
+#
+###############################
+def sendRequest(method, url, tokens=1, **kwargs):
+  response = None
+
+  for attempt in range(config.GOOGLE_MAX_RETRIES + 1):
+    waited = _rateLimiter.acquire(tokens)
+    countStat('wait_seconds', waited)
+    countStat('requests')
+    if attempt:
+      countStat('retries')
+
+    try:
+      response = method(url, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+      if attempt == config.GOOGLE_MAX_RETRIES:
+        countStat('failures')
+        raise
+      time.sleep(backoffDelay(attempt))
+      continue
+
+    if response.status_code == 429:
+      countStat('throttled')
+      _rateLimiter.throttled()
+    elif response.status_code >= 500:
+      countStat('server_errors')
+    else:
+      _rateLimiter.succeeded()
+      return response
+
+    if attempt < config.GOOGLE_MAX_RETRIES:
+      time.sleep(retryAfterDelay(response) or backoffDelay(attempt))
+
+  countStat('failures')
+  return response
+
+def backoffDelay(attempt):
+  # full jitter exponential backoff
+  return random.uniform(0, min(config.GOOGLE_BACKOFF_MAX, config.GOOGLE_BACKOFF_BASE * 2 ** attempt))
+
+def retryAfterDelay(response):
+  # Retry-After is either seconds or an http date
+  retryAfter = response.headers.get('Retry-After')
+  if not retryAfter:
+    return None
+  try:
+    delay = float(retryAfter)
+  except ValueError:
+    try:
+      delay = (parsedate_to_datetime(retryAfter).replace(tzinfo=None) - datetime.utcnow()).total_seconds()
+    except (TypeError, ValueError):
+      return None
+
+  return min(config.GOOGLE_BACKOFF_MAX, max(0.0, delay))
+
+def countStat(name, amount=1):
+  with _statsLock:
+    _stats[name] += amount
+
+###############################
+#
+# Counters of calls made to the Google Pay API for Passes
+#
+# @return Dict stats - copy of the counters plus the current rate limit
+#
+###############################
+def getStats():
+  with _statsLock:
+    stats = dict(_stats)
+  stats['rate_limit'] = _rateLimiter.rate
+
+  return stats
+
 ###############################
 #
 # Insert class with Google Pay API for Passes REST API
@@ -41,25 +177,24 @@ def insertClass(verticalType, payload):
     'Accept': 'application/json',
     'Content-Type': 'application/json; charset=UTF-8'
   }
-  credentials = makeOauthCredential()
   response = None
 
   # Define insert() REST call of target vertical
-  uri = 'https://walletobjects.googleapis.com/walletobjects/v1'
+  uri = WALLET_OBJECTS_URI
   postfix = 'Class'
   path = createPath(verticalType, postfix)
 
   # There is no Google API for Passes Client Library for Python.
-  # Authorize a http client with credential generated from Google API client library.
+  # Reuse the process-wide http client authorized with our service account credential.
   ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  authed_session = AuthorizedSession(credentials)
+  authed_session = getAuthorizedSession()
 
   # make the POST request to make an insert(); this returns a response object
   # other methods require different http methods; for example, get() requires authed_Session.get(...)
   # check the reference API to make the right REST call
   ## https://developers.google.com/pay/passes/reference/v1/
   ## https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  response = authed_session.post(
+  response = sendRequest(authed_session.post,
       uri+path,         # REST API endpoint
       headers=headers,  # Header; optional
       json=payload    # non-form-encoded Payload for POST. Check rest API for format based on method.
@@ -84,28 +219,67 @@ def getClass(verticalType, classId):
     'Accept': 'application/json',
     'Content-Type': 'application/json; charset=UTF-8'
   }
-  credentials = makeOauthCredential()
   response = None
 
   # Define get() REST call of target vertical
-  uri = 'https://walletobjects.googleapis.com/walletobjects/v1'
+  uri = WALLET_OBJECTS_URI
 
   postfix = 'Class'
   path = createPath(verticalType, postfix, classId)
 
   # There is no Google API for Passes Client Library for Python.
-  # Authorize a http client with credential generated from Google API client library.
+  # Reuse the process-wide http client authorized with our service account credential.
   ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  authed_session = AuthorizedSession(credentials)
+  authed_session = getAuthorizedSession()
 
   # make the GET request to make an get(); this returns a response object
   # other methods require different http methods; for example, get() requires authed_Session.get(...)
   # check the reference API to make the right REST call
   ## https://developers.google.com/pay/passes/reference/v1/
   ## https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  response = authed_session.get(
-      uri+path          # REST API endpoint
-      ,headers=headers  # Header; optional
+  response = sendRequest(authed_session.get,
+      uri+path,         # REST API endpoint
+      headers=headers   # Header; optional
+    )
+
+  return response
+
+###############################
+#
+# Update existing class with Google Pay API for Passes REST API
+#
+# See https://developers.google.com/pay/passes/reference/v1/
+#
+# @param VerticalType verticalType - type of pass
+# @param String classId - unique identifier for a class
+# @param Dict payload - represents class resource
+# @return requests.Response response - response from REST call
+#
+###############################
+def updateClass(verticalType, classId, payload):
+
+  headers = {
+    'Accept': 'application/json',
+    'Content-Type': 'application/json; charset=UTF-8'
+  }
+  response = None
+
+  # Define update() REST call of target vertical
+  uri = WALLET_OBJECTS_URI
+  postfix = 'Class'
+  path = createPath(verticalType, postfix, classId)
+
+  # There is no Google API for Passes Client Library for Python.
+  # Reuse the process-wide http client authorized with our service account credential.
+  ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
+  authed_session = getAuthorizedSession()
+
+  # make the PUT request to make an update(); this replaces the whole class resource
+  ## https://developers.google.com/pay/passes/reference/v1/
+  response = sendRequest(authed_session.put,
+      uri+path,         # REST API endpoint
+      headers=headers,  # Header; optional
+      json=payload    # non-form-encoded Payload for PUT. Check rest API for format based on method.
     )
 
   return response
@@ -127,24 +301,23 @@ def insertObject(verticalType, payload):
     'Accept': 'application/json',
     'Content-Type': 'application/json; charset=UTF-8'
   }
-  credentials = makeOauthCredential()
   response = None
 
   # Define insert() REST call of target vertical
-  uri = 'https://walletobjects.googleapis.com/walletobjects/v1'
+  uri = WALLET_OBJECTS_URI
   postfix = 'Object'
   path = createPath(verticalType, postfix)
   # There is no Google API for Passes Client Library for Python.
-  # Authorize a http client with credential generated from Google API client library.
+  # Reuse the process-wide http client authorized with our service account credential.
   ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  authed_session = AuthorizedSession(credentials)
+  authed_session = getAuthorizedSession()
  
   # make the POST request to make an insert(); this returns a response object
   # other methods require different http methods; for example, get() requires authed_Session.get(...)
   # check the reference API to make the right REST call
   ## https://developers.google.com/pay/passes/reference/v1/
   ## https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  response = authed_session.post(
+  response = sendRequest(authed_session.post,
       uri+path,          # REST API endpoint
       headers=headers,  # Header; optional
       json=payload    # non-form-encoded Payload for POST. Check rest API for format based on method.
@@ -168,25 +341,24 @@ def getObject(verticalType, objectId):
     'Accept': 'application/json',
     'Content-Type': 'application/json; charset=UTF-8'
   }
-  credentials = makeOauthCredential()
   response = None
 
   # Define get() REST call of target vertical
-  uri = 'https://walletobjects.googleapis.com/walletobjects/v1'
+  uri = WALLET_OBJECTS_URI
   postfix = 'Object'
   path = createPath(verticalType, postfix, objectId)
 
   # There is no Google API for Passes Client Library for Python.
-  # Authorize a http client with credential generated from Google API client library.
+  # Reuse the process-wide http client authorized with our service account credential.
   ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  authed_session = AuthorizedSession(credentials)
+  authed_session = getAuthorizedSession()
 
   # make the GET request to make an get(); this returns a response object
   # other methods require different http methods; for example, get() requires authed_Session.get(...)
   # check the reference API to make the right REST call
   ## https://developers.google.com/pay/passes/reference/v1/
   ## https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  response = authed_session.get(
+  response = sendRequest(authed_session.get,
       uri+path,          # REST API endpoint
       headers=headers  # Header; optional
     )
@@ -198,31 +370,175 @@ def updatePass(verticalType, objectId, objectResourcePayload):
     'Accept': 'application/json',
     'Content-Type': 'application/json; charset=UTF-8'
   }
-  credentials = makeOauthCredential()
   response = None
 
   # Define get() REST call of target vertical
-  uri = 'https://walletobjects.googleapis.com/walletobjects/v1'
+  uri = WALLET_OBJECTS_URI
   postfix = 'Object'
   path = createPath(verticalType, postfix, objectId)
  
   # There is no Google API for Passes Client Library for Python.
-  # Authorize a http client with credential generated from Google API client library.
+  # Reuse the process-wide http client authorized with our service account credential.
   ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  authed_session = AuthorizedSession(credentials)
+  authed_session = getAuthorizedSession()
 
   # make the GET request to make an get(); this returns a response object
   # other methods require different http methods; for example, get() requires authed_Session.get(...)
   # check the reference API to make the right REST call
   ## https://developers.google.com/pay/passes/reference/v1/
   ## https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
-  response = authed_session.put(
+  response = sendRequest(authed_session.put,
       uri+path,          # REST API endpoint
       headers=headers,  # Header; optional 
       json = objectResourcePayload
     )
   return response
 
+###############################
+#
+# Patch defined object with Google Pay API for Passes REST API
+#
+# See https://developers.google.com/pay/passes/reference/v1/
+#
+# @param VerticalType verticalType - represents type of pass being generated
+# @param String objectId - The unique identifier for an object.
+# @param Dict objectPatchPayload - only the object fields to change
+# @return requests.Response response - response from REST call
+#
+###############################
+def patchObject(verticalType, objectId, objectPatchPayload):
+
+  headers = {
+    'Accept': 'application/json',
+    'Content-Type': 'application/json; charset=UTF-8'
+  }
+  response = None
+
+  # Define patch() REST call of target vertical
+  uri = WALLET_OBJECTS_URI
+  postfix = 'Object'
+  path = createPath(verticalType, postfix, objectId)
+
+  # There is no Google API for Passes Client Library for Python.
+  # Reuse the process-wide http client authorized with our service account credential.
+  ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
+  authed_session = getAuthorizedSession()
+
+  # make the PATCH request to make a patch(); fields left out of the payload are unchanged
+  ## https://developers.google.com/pay/passes/reference/v1/
+  response = sendRequest(authed_session.patch,
+      uri+path,          # REST API endpoint
+      headers=headers,  # Header; optional
+      json=objectPatchPayload
+    )
+
+  return response
+
+###############################
+#
+# Send many object calls in one multipart batch request
+#
+# See https://developers.google.com/pay/passes/guides/get-started/basic-setup/batch-requests
+#
+# @param List calls - (String contentId, String method, String path, Dict payload) for each call
+# @return Dict responses - contentId -> (Integer status_code, String body) for each call answered
+#
+###############################
+def batchObjects(calls):
+
+  boundary = 'batch_' + uuid.uuid4().hex
+  headers = {
+    'Accept': 'application/json',
+    'Content-Type': 'multipart/mixed; boundary=' + boundary
+  }
+  response = None
+
+  # every call is an http request nested in its own part, Content-ID maps the response back
+  body = ''
+  for contentId, method, path, payload in calls:
+    body += '--' + boundary + '\r\n'
+    body += 'Content-Type: application/http\r\n'
+    body += 'Content-Transfer-Encoding: binary\r\n'
+    body += 'Content-ID: <' + contentId + '>\r\n\r\n'
+    body += method + ' ' + WALLET_OBJECTS_PATH + path + ' HTTP/1.1\r\n'
+    body += 'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+    body += json.dumps(payload) + '\r\n'
+  body += '--' + boundary + '--\r\n'
+
+  # There is no Google API for Passes Client Library for Python.
+  # Reuse the process-wide http client authorized with our service account credential.
+  ## see https://google-auth.readthedocs.io/en/latest/user-guide.html#making-authenticated-requests
+  authed_session = getAuthorizedSession()
+
+  response = sendRequest(authed_session.post,
+      BATCH_URI,        # batch endpoint
+      tokens=len(calls),  # Google counts every call in a batch against the quota
+      headers=headers,
+      data=body.encode('utf-8')
+    )
+  response.raise_for_status()
+
+  responses = parseBatchResponse(response)
+  countBatchStatuses(responses)
+  return responses
+
+###############################
+#
+# Feed the status of every call in a batch to the rate limiter and the counters
+#
+# The batch request itself succeeds even when Google throttles or fails some of its calls.
+#
+# @param Dict responses - contentId -> (Integer status_code, String body)
+#
+###############################
+def countBatchStatuses(responses):
+  throttled = False
+  for statusCode, _ in responses.values():
+    if statusCode == 429:
+      countStat('throttled')
+      throttled = True
+    elif statusCode >= 500:
+      countStat('server_errors')
+
+  if throttled:
+    # once per batch, like a throttled single call
+    _rateLimiter.throttled()
+
+###############################
+#
+# Split a multipart batch response into the responses of each call
+#
+# @param requests.Response response - response from a batch request
+# @return Dict responses - contentId -> (Integer status_code, String body)
+#
+###############################
+def parseBatchResponse(response):
+  responses = {}
+
+  boundary = response.headers['Content-Type'].split('boundary=')[1].strip('"')
+  for part in response.text.replace('\r\n', '\n').split('--' + boundary):
+    part = part.strip()
+    if not part or part == '--':
+      continue
+
+    partHeaders, _, httpResponse = part.partition('\n\n')
+    contentId = None
+    for header in partHeaders.split('\n'):
+      name, _, value = header.partition(':')
+      if name.strip().lower() == 'content-id':
+        # Google answers <contentId> with <response-contentId>
+        contentId = value.strip().strip('<>')
+        if contentId.startswith('response-'):
+          contentId = contentId[len('response-'):]
+    if contentId is None:
+      continue
+
+    statusLine, _, httpResponse = httpResponse.partition('\n')
+    _, _, httpBody = httpResponse.partition('\n\n')
+    responses[contentId] = (int(statusLine.split(' ')[1]), httpBody)
+
+  return responses
+
 ###############################
 #
 # Creates path for part of uri
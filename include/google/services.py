@@ -1,5 +1,9 @@
+import hashlib, json, logging, threading
 from enum import Enum
 
+import requests
+
+import include.crud as crud
 import include.google.restMethods as restMethods
 import include.google.resourceDefinitions as resourceDefinitions
 import include.google.jwt as jwt
@@ -9,6 +13,12 @@ import config
 EXISTS_MESSAGE = "No changes will be made when saved by link. To update info, use update() or patch(). For an example, see https://developers.google.com/pay/passes/guides/get-started/implementing-the-api/engage-through-google-pay#update-state\n"
 NOT_EXIST_MESSAGE = "Will be inserted when user saves by link/button for first time\n"
 
+logger = logging.getLogger('app')
+
+# classId -> hash of the class definition provisioned by this process
+_provisionedClasses = {}
+_provisionLock = threading.Lock()
+
 #############################
 #
 #  These are services that you would expose to front end so they can generate save links or buttons.
@@ -33,129 +43,325 @@ class VerticalType(Enum):
 
 #############################
 #
-#  Output to explain various status codes from a get API call
+#  Hashes a resource definition so changes to it can be detected
 #
-#  @param requests.Response getCallResponse - response from a get call
-#  @param String idType - identifier of type of get call.  "object" or "class"
-#  @param String id - unique identifier of Pass for given idType
-#  @param String checkClassId - optional. ClassId to check for if objectId exists, and idType == 'object'
-#  @return void
+#  @param Dict resourcePayload - class or object resource
+#  @return String definitionHash - sha256 hex digest of the canonical JSON
 #
 #############################
-def handleGetCallStatusCode(getCallResponse, idType, id, checkClassId=None):
-  if getCallResponse.status_code == 200:  # id resource exists for this issuer account
-    #print('%sId: (%s) already exists. %s' % (idType, id, EXISTS_MESSAGE))
+def hashDefinition(resourcePayload):
+  canonical = json.dumps(resourcePayload, sort_keys=True, separators=(',', ':'))
 
-    # for object get, do additional check
-    if idType == "object":
-      # check if object's classId matches target classId
-      classIdOfObjectId = getCallResponse.json()['classId']
-      if classIdOfObjectId != checkClassId and checkClassId is not None:
-        raise ValueError('the classId of inserted object is (%s). It does not match the target classId (%s). The saved object will not have the class properties you expect.' % (classIdOfObjectId, checkClassId))
-  elif getCallResponse.status_code == 404:  # id resource does not exist for this issuer account
-    pass #print('%sId: (%s) does not exist. %s' % (idType, id , NOT_EXIST_MESSAGE) )
-  else:
-    raise ValueError('Issue with getting %s.' % (idType), getCallResponse.text)
-
-  return
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
 #############################
 #
-#  Output to explain various status codes from a insert API call
+#  Makes sure the class exists on Google's server with the current definition
 #
-#  @param requests.Response insertCallResponse - response from an insert call
-#  @param String idType - identifier of type of get call.  "object" or "class"
-#  @param String id - unique identifier of Pass for given idType
-#  @param String checkClassId - optional. ClassId to check for if objectId exists, and idType == 'object'
-#  @param VerticalType verticalType - optional. VerticalType to fetch ClassId of existing objectId.
-#  @return void
+#  The class is only inserted (or updated) when the hash of its definition differs
+#  from the one last provisioned, so this is cheap to call at startup or per pass.
+#
+#  @param Session db - database session
+#  @param VerticalType verticalType - type of pass
+#  @param String classId - unique identifier for a class
+#  @param Boolean force - optional. Push the class definition even if it is unchanged
+#  @return Boolean provisioned - True if a REST call was made
 #
 #############################
-def handleInsertCallStatusCode(insertCallResponse, idType, id,objectResourcePayload, checkClassId=None, verticalType=None):
-  if insertCallResponse.status_code == 200:
-    pass #print('%sId (%s) insertion success!\n' % (idType, id) )
-  elif insertCallResponse.status_code == 409:  # id resource exists for this issuer account
-    #print('%sId: (%s) already exists. %s' % (idType, id, EXISTS_MESSAGE))
-    
-    # for object insert, do additional check
-    if idType == "object":
-      getCallResponse = None
-      # get existing object Id data
-      getCallResponse = restMethods.getObject(verticalType, id) # if it is a new object Id, expected status is 409
-      if getCallResponse != 409:
-        restMethods.updatePass(verticalType, id, objectResourcePayload)
-
-      # check if object's classId matches target classId
-      classIdOfObjectId = getCallResponse.json()['classId']
-      if classIdOfObjectId != checkClassId and checkClassId is not None:
-        raise ValueError('the classId of inserted object is (%s). It does not match the target classId (%s). The saved object will not have the class properties you expect.' % (classIdOfObjectId, checkClassId))
-  else:
-    raise ValueError('%s insert issue.' % (idType), insertCallResponse.text)
+def provisionClass(db, verticalType, classId, force=False):
+  classResourcePayload = resourceDefinitions.makeLoyaltyClassResource(classId)
+  definitionHash = hashDefinition(classResourcePayload)
 
-  return
+  with _provisionLock:
+    if not force and _provisionedClasses.get(classId) == definitionHash:
+      # already provisioned by this process
+      return False
 
-def makeSkinnyJwt(verticalType, classId, objectId, user):
+    dbClass = crud.get_google_class(db, classId)
+    if not force and dbClass and dbClass.definition_hash == definitionHash:
+      # already provisioned by another process or an earlier run
+      _provisionedClasses[classId] = definitionHash
+      return False
 
-  signedJwt = None
-  classResourcePayload = None
-  objectResourcePayload = None
-  classResponse = None
-  objectResponse = None
-  
-  try:
-    # get class definition and object definition
-    classResourcePayload, objectResourcePayload = getClassAndObjectDefinitions(verticalType, classId, objectId, classResourcePayload, objectResourcePayload, user)
-
-    #print('\nMaking REST call to insert class: (%s)' % (classId))
     # make authorized REST call to explicitly insert class into Google server.
     # if this is successful, you can check/update class definitions in Merchant Center GUI: https://pay.google.com/gp/m/issuer/list
     classResponse = restMethods.insertClass(verticalType, classResourcePayload)
+    if classResponse.status_code == 409:
+      # class exists but its definition changed, replace it
+      classResponse = restMethods.updateClass(verticalType, classId, classResourcePayload)
+    if classResponse.status_code != 200:
+      raise ValueError('class provisioning issue.', classResponse.text)
+
+    crud.set_google_class(db, classId, definitionHash)
+    _provisionedClasses[classId] = definitionHash
+
+  return True
+
+#############################
+#
+#  Fingerprints each top-level module of an object resource
+#
+#  @param Dict objectResourcePayload - object resource
+#  @return Dict fingerprint - module name -> hash of the module
+#
+#############################
+def fingerprintObject(objectResourcePayload):
+  return {module: hashDefinition(value) for module, value in objectResourcePayload.items() if module != 'id'}
 
-    #print('\nMaking REST call to insert object')
+#############################
+#
+#  Checks that an object returned by Google belongs to the target class
+#
+#  @param requests.Response response - response holding an object resource
+#  @param String checkClassId - classId the object should have
+#  @return void
+#
+#############################
+def checkObjectClassId(response, checkClassId):
+  classIdOfObjectId = response.json().get('classId')
+  if classIdOfObjectId != checkClassId:
+    raise ValueError('the classId of inserted object is (%s). It does not match the target classId (%s). The saved object will not have the class properties you expect.' % (classIdOfObjectId, checkClassId))
+
+#############################
+#
+#  Syncs a pass's object to Google's server with as few REST calls as possible
+#
+#  The database records whether the object exists and the fingerprint of what was
+#  last synced. New objects are inserted, existing objects get a single PATCH with
+#  only the modules that changed, and unchanged objects make no REST call at all.
+#
+#  @param Session db - database session
+#  @param VerticalType verticalType - type of pass
+#  @param String classId - unique identifier for a class
+#  @param String objectId - unique identifier for an object
+#  @param Pass user - database pass to sync
+#  @param String heroImageVersion - optional. Version of the rendered hero image
+#  @return String result - 'inserted', 'patched' or 'unchanged'
+#
+#############################
+def syncObject(db, verticalType, classId, objectId, user, heroImageVersion=None):
+  objectResourcePayload = resourceDefinitions.makeLoyaltyObjectResource(classId, objectId, user, heroImageVersion)
+  fingerprint = fingerprintObject(objectResourcePayload)
+
+  dbObject = crud.get_google_object(db, user.serial_number)
+  if dbObject:
+    lastFingerprint = json.loads(dbObject.fingerprint)
+    changedModules = [module for module in fingerprint if lastFingerprint.get(module) != fingerprint[module]]
+    if not changedModules:
+      return 'unchanged'
+  else:
     # make authorized REST call to explicitly insert object into Google server.
     objectResponse = restMethods.insertObject(verticalType, objectResourcePayload)
+    if objectResponse.status_code == 200:
+      crud.set_google_object(db, user.serial_number, objectId, json.dumps(fingerprint))
+      return 'inserted'
+    elif objectResponse.status_code != 409:
+      raise ValueError('object insert issue.', objectResponse.text)
+    # object exists but was never synced by us, so every module may differ
+    changedModules = list(fingerprint)
 
-    # continue based on insert response status. Check https://developers.google.com/pay/passes/reference/v1/statuscodes
-    # check class insert response. Will print out if class insert succeeds or not. Throws error if class resource is malformed.
-    handleInsertCallStatusCode(classResponse, "class", classId, objectResourcePayload, None, None)
+  objectPatchPayload = {module: objectResourcePayload[module] for module in changedModules}
+  objectResponse = restMethods.patchObject(verticalType, objectId, objectPatchPayload)
+  if objectResponse.status_code == 404:
+    # object was removed from Google's server, insert it again
+    crud.delete_google_object(db, user.serial_number)
+    return syncObject(db, verticalType, classId, objectId, user, heroImageVersion)
+  elif objectResponse.status_code != 200:
+    raise ValueError('object patch issue.', objectResponse.text)
+  checkObjectClassId(objectResponse, classId)
 
-    # check object insert response. Will print out if object insert succeeds or not. Throws error if object resource is malformed, or if existing objectId's classId does not match the expected classId
-    handleInsertCallStatusCode(objectResponse, "object", objectId, objectResourcePayload, classId, verticalType)
+  crud.set_google_object(db, user.serial_number, objectId, json.dumps(fingerprint))
+  return 'patched'
 
-    # put into JSON Web Token (JWT) format for Google Pay API for Passes
-    googlePassJwt = jwt.googlePassJwt()
-    
-    # only need to add objectId in JWT because class and object definitions were pre-inserted via REST call
-    loadObjectIntoJWT(verticalType, googlePassJwt, {"id": objectId})
+#############################
+#
+#  Makes the object ID of a pass
+#
+#  check Reference API for format of "id" (https://developers.google.com/pay/passes/reference/v1/).
+#
+#  @param VerticalType verticalType - type of pass
+#  @param String serialNumber - serial number of the pass
+#  @return String objectId - unique identifier for the object
+#
+#############################
+def makeObjectId(verticalType, serialNumber):
+  objectUid = str(verticalType).split('.')[1] + '_OBJECT_' + str(serialNumber)
+
+  return '%s.%s' % (config.ISSUER_ID, objectUid)
+
+#############################
+#
+#  Syncs many objects to Google's server with multipart batch requests
+#
+#  Works like syncObject, but inserts and patches are sent config.GOOGLE_BATCH_SIZE
+#  at a time. Each call is tagged with the pass's serial number so its response maps
+#  back to the right pass, and only calls that failed with a retryable status are
+#  sent again (up to config.GOOGLE_BATCH_RETRIES more times).
+#
+#  @param Session db - database session
+#  @param VerticalType verticalType - type of pass
+#  @param String classId - unique identifier for a class
+#  @param List items - (Pass user, String heroImageVersion) for each pass to sync
+#  @param Integer batchSize - optional. Calls per batch request
+#  @return Dict results - serial number -> 'inserted', 'patched', 'unchanged' or 'failed'
+#
+#############################
+def batchSyncObjects(db, verticalType, classId, items, batchSize=None):
+  batchSize = batchSize or config.GOOGLE_BATCH_SIZE
+  results = {}
+  pending = {}
 
-    # sign JSON to make signed JWT
-    signedJwt = googlePassJwt.generateSignedJwt()
+  provisionClass(db, verticalType, classId)
 
-  except ValueError as err:
-      print(err.args)
+  for user, heroImageVersion in items:
+    objectId = makeObjectId(verticalType, user.serial_number)
+    objectResourcePayload = resourceDefinitions.makeLoyaltyObjectResource(classId, objectId, user, heroImageVersion)
+    fingerprint = fingerprintObject(objectResourcePayload)
+    sync = {'objectId': objectId, 'payload': objectResourcePayload, 'fingerprint': fingerprint}
 
-  # return "skinny" JWT. Try putting it into save link.
-  # See https://developers.google.com/pay/passes/guides/get-started/implementing-the-api/save-to-google-pay#add-link-to-email
-  return signedJwt
+    dbObject = crud.get_google_object(db, user.serial_number)
+    if dbObject:
+      lastFingerprint = json.loads(dbObject.fingerprint)
+      changedModules = [module for module in fingerprint if lastFingerprint.get(module) != fingerprint[module]]
+      if not changedModules:
+        results[user.serial_number] = 'unchanged'
+        continue
+      pending[user.serial_number] = makeBatchPatch(verticalType, sync, changedModules)
+    else:
+      pending[user.serial_number] = makeBatchInsert(verticalType, sync)
+
+  for attempt in range(config.GOOGLE_BATCH_RETRIES + 1):
+    if not pending:
+      break
+
+    retry = {}
+    serialNumbers = list(pending)
+    for i in range(0, len(serialNumbers), batchSize):
+      chunk = serialNumbers[i:i + batchSize]
+      calls = [(serialNumber, pending[serialNumber]['method'], pending[serialNumber]['path'], pending[serialNumber]['body']) for serialNumber in chunk]
+
+      try:
+        responses = restMethods.batchObjects(calls)
+      except Exception:
+        # whole batch failed in transit, retry all of it
+        responses = {}
 
+      for serialNumber in chunk:
+        sync = pending[serialNumber]
+        status, body = responses.get(serialNumber, (None, None))
+        if status == 200:
+          crud.set_google_object(db, serialNumber, sync['objectId'], json.dumps(sync['fingerprint']), commit=False)
+          results[serialNumber] = 'inserted' if sync['method'] == 'POST' else 'patched'
+        elif status == 409 and sync['method'] == 'POST':
+          # object exists but was never synced by us, so every module may differ
+          retry[serialNumber] = makeBatchPatch(verticalType, sync, list(sync['fingerprint']))
+        elif status == 404 and sync['method'] == 'PATCH':
+          # object was removed from Google's server, insert it again
+          crud.delete_google_object(db, serialNumber)
+          retry[serialNumber] = makeBatchInsert(verticalType, sync)
+        elif status is None or status == 429 or status >= 500:
+          retry[serialNumber] = sync
+        else:
+          results[serialNumber] = 'failed'
+      db.commit()
+
+    pending = retry
+
+  for serialNumber in pending:
+    results[serialNumber] = 'failed'
+
+  return results
+
+def makeBatchInsert(verticalType, sync):
+  return dict(sync, method='POST', path=restMethods.createPath(verticalType, 'Object'), body=sync['payload'])
+
+def makeBatchPatch(verticalType, sync, changedModules):
+  objectPatchPayload = {module: sync['payload'][module] for module in changedModules}
+  return dict(sync, method='PATCH', path=restMethods.createPath(verticalType, 'Object', sync['objectId']), body=objectPatchPayload)
 
 #############################
 #
-#  Gets a passes's class and object definitions and loads into payload objects
+#  Signs a JWT that only references an object already on Google's server
+#
+#  Makes no REST call, so it is only safe once the object has been synced.
 #
 #  @param VerticalType verticalType - type of pass
-#  @param String classId - unique identifier for an class
-#  @param String classResourcePayload - payload for the class
-#  @param String objectResourcePayload - payload for the object
+#  @param String objectId - unique identifier for an object
+#  @return String signedJwt - signed "skinny" JWT
 #
 #############################
-def getClassAndObjectDefinitions(verticalType, classId, objectId, classResourcePayload, objectResourcePayload, user):
-  # get class definition and object definition
+def signObjectJwt(verticalType, objectId):
+  googlePassJwt = jwt.googlePassJwt()
+  loadObjectIntoJWT(verticalType, googlePassJwt, {"id": objectId})
 
-  classResourcePayload = resourceDefinitions.makeLoyaltyClassResource(classId)
-  objectResourcePayload = resourceDefinitions.makeLoyaltyObjectResource(classId, objectId, user)
+  return googlePassJwt.generateSignedJwt()
+
+#############################
+#
+#  Makes a "fat" JWT that carries the object itself, without any REST call
+#
+#  Google inserts the object when the user saves the pass. Locations are left
+#  out when the class is provisioned, since the class already carries them and
+#  the save link has to stay short.
+#
+#  @param VerticalType verticalType - type of pass
+#  @param String classId - unique identifier for a class
+#  @param String objectId - unique identifier for an object
+#  @param Pass user - database pass
+#  @param String heroImageVersion - optional. Version of the rendered hero image
+#  @return String signedJwt - signed "fat" JWT, or None if its save link would be too long
+#
+#############################
+def makeFatJwt(verticalType, classId, objectId, user, heroImageVersion=None):
+  googlePassJwt = jwt.googlePassJwt()
+
+  objectResourcePayload = resourceDefinitions.makeLoyaltyObjectResource(classId, objectId, user, heroImageVersion)
+  if classId in _provisionedClasses:
+    objectResourcePayload.pop('locations', None)
+  else:
+    loadClassIntoJWT(verticalType, googlePassJwt, resourceDefinitions.makeLoyaltyClassResource(classId))
+  loadObjectIntoJWT(verticalType, googlePassJwt, objectResourcePayload)
+
+  signedJwt = googlePassJwt.generateSignedJwt()
+  if len(config.SAVE_LINK) + len(signedJwt) > config.GOOGLE_MAX_LINK_LENGTH:
+    # too long for browsers and Google, caller falls back to a skinny JWT
+    return None
+
+  return signedJwt
+
+def makeSkinnyJwt(db, verticalType, classId, objectId, user, heroImageVersion=None):
+
+  signedJwt = None
+
+  # put into JSON Web Token (JWT) format for Google Pay API for Passes
+  googlePassJwt = jwt.googlePassJwt()
+
+  try:
+    # class is provisioned once per definition, this is a no-op on the hot path
+    provisionClass(db, verticalType, classId)
+
+    # make sure the object on Google's server matches the pass.
+    # Check https://developers.google.com/pay/passes/reference/v1/statuscodes
+    syncObject(db, verticalType, classId, objectId, user, heroImageVersion)
+
+    # only need to add objectId in JWT because class and object definitions were pre-inserted via REST call
+    loadObjectIntoJWT(verticalType, googlePassJwt, {"id": objectId})
+
+  except (ValueError, requests.exceptions.RequestException) as err:
+    # Google refused or could not be reached even after retries. Embed the resources
+    # instead so the save link still works, Google inserts them when the pass is saved
+    logger.error('Google sync failed for object (' + objectId + '): ' + str(err.args))
+    if classId not in _provisionedClasses:
+      loadClassIntoJWT(verticalType, googlePassJwt, resourceDefinitions.makeLoyaltyClassResource(classId))
+    loadObjectIntoJWT(verticalType, googlePassJwt, resourceDefinitions.makeLoyaltyObjectResource(classId, objectId, user, heroImageVersion))
+
+  # sign JSON to make signed JWT
+  signedJwt = googlePassJwt.generateSignedJwt()
+
+  # return "skinny" JWT. Try putting it into save link.
+  # See https://developers.google.com/pay/passes/guides/get-started/implementing-the-api/save-to-google-pay#add-link-to-email
+  return signedJwt
 
-  return classResourcePayload, objectResourcePayload
 
 #############################
 #
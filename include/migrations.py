@@ -0,0 +1,63 @@
+'''
+migrations.py: Brings an existing database up to date with the models.
+create_all only adds missing tables, so changes to existing tables are applied here.
+Every step is safe to run again.
+'''
+
+import os
+
+from sqlalchemy import select, update, func, inspect
+from sqlalchemy.schema import CreateColumn
+
+import include.storage as storage
+from include.models import Pass, Registration
+
+# files written before the blob store, still served until they are imported
+LEGACY_PKPASS = 'passes/{}.pkpass'
+LEGACY_HERO = 'static/heroImg/{}.png'
+
+def dedupe_registrations(conn):
+    '''
+    Keeps the oldest registration of each device & pass pair
+    '''
+    keep = select(func.min(Registration.index)).group_by(Registration.device_id, Registration.serial_number)
+    conn.execute(Registration.__table__.delete().where(~Registration.index.in_(keep)))
+
+def add_columns(conn):
+    '''
+    Adds columns added to tables that already exist
+    '''
+    for table in (Pass.__table__,):
+        existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.exec_driver_sql('ALTER TABLE ' + table.name + ' ADD COLUMN ' + str(CreateColumn(column).compile(conn)))
+
+def import_files(conn):
+    '''
+    Moves pkpass files & hero images written before the blob store into it, the files are left in place.
+    Run once with manage.py after upgrading, it reads every legacy file so the server doesn't run it at start,
+    until then the files are served from where they are
+    '''
+    for column, path in ((Pass.pkpass_key, LEGACY_PKPASS), (Pass.hero_key, LEGACY_HERO)):
+        serial_numbers = conn.execute(select(Pass.serial_number).where(column.is_(None))).scalars().all()
+        for serial_number in serial_numbers:
+            if os.path.exists(path.format(serial_number)):
+                with open(path.format(serial_number), 'rb') as legacy_file:
+                    key = storage.store.put(legacy_file)
+                conn.execute(update(Pass).where(Pass.serial_number==serial_number).values({column.key: key}))
+
+def create_indexes(conn):
+    '''
+    Creates indexes added to tables that already exist
+    '''
+    for table in (Pass.__table__, Registration.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def migrate(engine):
+    with engine.begin() as conn:
+        # duplicates must go before the unique index is created
+        dedupe_registrations(conn)
+        add_columns(conn)
+        create_indexes(conn)
@@ -2,7 +2,7 @@
 models.py: Create SQLAlchemy models from the Base class
 '''
 
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, Boolean
 
 from include.database import Base
 
@@ -17,8 +17,12 @@ class Pass(Base):
 
     pass_type = Column(String) # pass type ID
     serial_number = Column(String, primary_key=True, index=True)
-    last_update = Column(DateTime)
+    last_update = Column(DateTime, index=True)
     pass_hash = Column(String, unique=True, index=True)
+    etag = Column(String) # sha1 of the manifest of the built pkpass
+    built_at = Column(DateTime) # last_update of the pass data the pkpass was built from
+    pkpass_key = Column(String, index=True) # blob store key of the built pkpass
+    hero_key = Column(String, index=True) # blob store key of the rendered Google hero image
 
     auth_token = Column(String)
     name = Column(String)
@@ -37,3 +41,84 @@ class Registration(Base):
     index =  Column(Integer, primary_key=True)
     device_id = Column(String) # device library identifier
     serial_number = Column(String)
+
+    __table_args__ = (
+        Index('ix_registrations_device_serial', 'device_id', 'serial_number', unique=True), # one registration per device & pass
+        Index('ix_registrations_serial_number', 'serial_number'), # devices of a pass
+    )
+
+class GoogleClass(Base):
+    __tablename__ = "google_classes"
+
+    class_id = Column(String, primary_key=True, index=True) # Google Pay API class ID
+    definition_hash = Column(String) # hash of the last provisioned class definition
+    last_sync = Column(DateTime)
+
+class GoogleObject(Base):
+    __tablename__ = "google_objects"
+
+    serial_number = Column(String, primary_key=True, index=True) # a row means the object exists on Google's server
+    object_id = Column(String) # Google Pay API object ID
+    fingerprint = Column(Text) # JSON of hashes of each object module last synced
+    last_sync = Column(DateTime)
+
+class PassChange(Base):
+    __tablename__ = "pass_changes"
+    __table_args__ = {'sqlite_autoincrement': True} # never reuse a seq
+
+    seq = Column(Integer, primary_key=True) # increases with every change, the version other workers sync from
+    serial_number = Column(String, unique=True, index=True) # only the latest change of each pass is kept
+    pass_hash = Column(String)
+    changed_at = Column(DateTime)
+
+class DeviceChange(Base):
+    __tablename__ = "device_changes"
+    __table_args__ = {'sqlite_autoincrement': True} # never reuse a seq
+
+    seq = Column(Integer, primary_key=True) # increases with every change, the version other workers sync from
+    device_id = Column(String, unique=True, index=True) # only the latest registration change of each device is kept
+    changed_at = Column(DateTime)
+
+class ScanEvent(Base):
+    __tablename__ = "scan_events"
+    __table_args__ = {'sqlite_autoincrement': True} # append-only, ids are never reused
+
+    id = Column(Integer, primary_key=True)
+    scanned_at = Column(DateTime, index=True)
+    reader = Column(String)
+    serial_number = Column(String) # None if the barcode was not accepted
+    accepted = Column(Boolean)
+
+class ScanRollup(Base):
+    __tablename__ = "scan_rollups"
+
+    reader = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True) # start of the SCAN_ROLLUP_BUCKET the scans fall in
+    scans = Column(Integer)
+    accepted = Column(Integer)
+
+class ServerSecret(Base):
+    __tablename__ = "server_secrets"
+
+    name = Column(String, primary_key=True)
+    value = Column(String) # generated once, shared by every worker
+
+class SeenBarcode(Base):
+    __tablename__ = "seen_barcodes"
+
+    message = Column(String, primary_key=True) # barcode message accepted by a reader
+    reader = Column(String) # reader that scanned it, the same reader may retry
+    expires_at = Column(DateTime, index=True) # the message may be scanned again after this
+
+class RegistrationJob(Base):
+    __tablename__ = "registration_jobs"
+
+    job_id = Column(String, primary_key=True)
+    state = Column(String) # ready, invalid or failed, so any worker can answer a poll
+    finished_at = Column(DateTime, index=True)
+
+class ReleasedBlob(Base):
+    __tablename__ = "released_blobs"
+
+    key = Column(String, primary_key=True) # blob no longer referenced by the pass that replaced it
+    released_at = Column(DateTime, index=True) # deleted by the sweep after BLOB_DELETE_GRACE
@@ -0,0 +1,66 @@
+'''
+offload.py: The boundary between the event loop & blocking work.
+Async endpoints must not touch a Session, requests, PIL or openssl directly,
+they hand that work to a thread with run() & the watchdog reports any lag left.
+'''
+
+import asyncio, logging, time
+
+from starlette.concurrency import run_in_threadpool
+
+import config
+from include.database import SessionLocal
+
+logger = logging.getLogger('app')
+
+def with_session(func, *args, **kwargs):
+    '''
+    Calls func(db, *args) with a session owned by the calling thread
+    '''
+    db = SessionLocal()
+    try:
+        return func(db, *args, **kwargs)
+    finally:
+        db.close()
+
+async def run(func, *args, **kwargs):
+    '''
+    Awaits func(db, *args) in the thread pool so the event loop keeps serving requests
+    '''
+    return await run_in_threadpool(with_session, func, *args, **kwargs)
+
+class LoopWatchdog():
+    '''
+    Measures how late the event loop wakes up, any blocking call on the loop shows up as lag
+    '''
+    def __init__(self, interval: float, warn: float):
+        self.interval = interval
+        self.warn = warn
+        self.task = None
+        self.counts = {'checks': 0, 'stalls': 0, 'max_lag_ms': 0.0, 'last_lag_ms': 0.0}
+
+    async def watch(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.counts['checks'] += 1
+            self.counts['last_lag_ms'] = round(lag * 1000, 3)
+            self.counts['max_lag_ms'] = max(self.counts['max_lag_ms'], self.counts['last_lag_ms'])
+            if lag > self.warn:
+                self.counts['stalls'] += 1
+                logger.warning('Event loop blocked for ' + str(round(lag * 1000)) + ' ms')
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.watch())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return dict(self.counts)
+
+watchdog = LoopWatchdog(config.LOOP_LAG_INTERVAL, config.LOOP_LAG_WARN)
@@ -0,0 +1,104 @@
+'''
+passindex.py: In-memory pass_hash -> serial_number index for scan lookups.
+Rotations made by this worker are applied right away. Rotations made by other
+workers are read from the pass_changes table at most SCAN_INDEX_SYNC_INTERVAL
+seconds later, so every worker sees a new hash within a bounded delay.
+'''
+
+import threading, time
+
+import config, include.crud as crud
+from include.cache import LRUCache
+
+class PassIndex():
+    '''
+    Maps every current pass_hash to its serial_number, with a negative cache of unknown hashes
+    '''
+    def __init__(self):
+        self.hashes = {} # pass_hash -> serial_number
+        self.serials = {} # serial_number -> pass_hash
+        self.version = None # last pass_changes seq applied, None until loaded
+        self.synced = 0.0
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.unknown = LRUCache(config.SCAN_NEGATIVE_CACHE_SIZE, config.SCAN_NEGATIVE_CACHE_TTL)
+        self.listeners = list() # also called with the serial_number of every pass another worker changed
+        self.counts = {'hits': 0, 'unknown_hits': 0, 'db_lookups': 0, 'syncs': 0}
+
+    def load(self, db):
+        '''
+        Builds the index from the database
+        '''
+        # read the version first, changes made while loading are applied again by the next sync
+        version = crud.get_change_version(db)
+        rows = crud.get_pass_hashes(db)
+        with self.lock:
+            self.hashes = {row.pass_hash: row.serial_number for row in rows}
+            self.serials = {row.serial_number: row.pass_hash for row in rows}
+            self.version = version
+            self.synced = time.monotonic()
+        self.unknown.clear()
+
+    def sync(self, db, force: bool = False):
+        '''
+        Applies changes other workers logged since the last sync
+        '''
+        if self.version is None:
+            self.load(db)
+            return
+        if not force and time.monotonic() - self.synced < config.SCAN_INDEX_SYNC_INTERVAL:
+            return
+        if not self.sync_lock.acquire(blocking=False):
+            # another thread is already syncing
+            return
+        try:
+            self.synced = time.monotonic()
+            self.counts['syncs'] += 1
+            for change in crud.get_changes_since(db, self.version):
+                self.apply(change.serial_number, change.pass_hash)
+                crud.pass_rows.pop(change.serial_number)
+                for listener in self.listeners:
+                    listener(change.serial_number)
+                self.version = change.seq
+        finally:
+            self.sync_lock.release()
+
+    def apply(self, serial_number: str, pass_hash: str):
+        '''
+        Points the index at the new pass_hash of a pass
+        '''
+        with self.lock:
+            old_hash = self.serials.get(serial_number)
+            if old_hash and self.hashes.get(old_hash) == serial_number:
+                del self.hashes[old_hash]
+            self.hashes[pass_hash] = serial_number
+            self.serials[serial_number] = pass_hash
+        self.unknown.pop(pass_hash)
+
+    def lookup(self, db, pass_hash: str):
+        '''
+        Returns the serial_number of the pass with pass_hash, or None
+        '''
+        self.sync(db)
+        serial_number = self.hashes.get(pass_hash)
+        if serial_number:
+            self.counts['hits'] += 1
+            return serial_number
+        if self.unknown.get(pass_hash):
+            # recently seen bad or replayed hash
+            self.counts['unknown_hits'] += 1
+            return None
+
+        # the hash may have rotated in another worker since the last sync
+        self.counts['db_lookups'] += 1
+        db_pass = crud.get_pass_by_hash(db, pass_hash)
+        if db_pass:
+            self.apply(db_pass.serial_number, pass_hash)
+            return db_pass.serial_number
+        self.unknown.set(pass_hash, True)
+        return None
+
+    def stats(self):
+        return dict(self.counts, size=len(self.hashes), version=self.version, unknown=len(self.unknown))
+
+index = PassIndex()
@@ -0,0 +1,133 @@
+'''
+pipeline.py: Independent lanes that rebuild passes after a database change.
+The Apple lane rebuilds the pkpass and pushes it to devices, the Google lane
+renders the hero image and syncs the object, so a slow Google API never delays
+an Apple device from fetching its updated pass.
+'''
+
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config, include.utils as utils, include.schemas as schemas
+from include.database import SessionLocal
+
+logger = logging.getLogger('app')
+
+class Lane():
+    '''
+    Bounded pool of threads for one kind of pass work
+    '''
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.max_workers = max_workers
+        self.queued = set() # keys waiting for a thread
+        self.lock = threading.Lock()
+        self.counts = {'submitted': 0, 'coalesced': 0, 'completed': 0, 'failed': 0, 'running': 0}
+
+    def submit(self, key, task, *args):
+        '''
+        Queues task unless the same key is already waiting,
+        in which case the queued run will pick up the latest data
+        '''
+        with self.lock:
+            if key is not None and key in self.queued:
+                self.counts['coalesced'] += 1
+                return False
+            if key is not None:
+                self.queued.add(key)
+            self.counts['submitted'] += 1
+
+        self.executor.submit(self.run, key, task, *args)
+        return True
+
+    def run(self, key, task, *args):
+        with self.lock:
+            self.queued.discard(key)
+            self.counts['running'] += 1
+        try:
+            task(*args)
+        except Exception:
+            # one failed pass must not stop the lane
+            logger.exception(self.name + ' lane failed for (' + str(key) + ')')
+            with self.lock:
+                self.counts['failed'] += 1
+        else:
+            with self.lock:
+                self.counts['completed'] += 1
+        finally:
+            with self.lock:
+                self.counts['running'] -= 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, queued=len(self.queued), max_workers=self.max_workers)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+apple = Lane('apple', config.APPLE_LANE_WORKERS)
+google = Lane('google', config.GOOGLE_LANE_WORKERS)
+
+def build_apple_pass(serial_number: str):
+    '''
+    Rebuilds the pkpass and notifies the pass's devices
+    '''
+    db = SessionLocal()
+    try:
+        schemas.Pkpass(db, serial_number)
+        utils.push_pass_update(db, serial_number)
+    finally:
+        db.close()
+
+def build_google_pass(serial_number: str):
+    '''
+    Renders the hero image and syncs the Google object
+    '''
+    db = SessionLocal()
+    try:
+        schemas.JWT(db, serial_number)
+    finally:
+        db.close()
+
+def build_google_batch(serial_numbers: list):
+    '''
+    Renders hero images and syncs the Google objects in batch requests
+    '''
+    db = SessionLocal()
+    try:
+        google_passes = list()
+        for serial_number in serial_numbers:
+            try:
+                google_passes.append(schemas.JWT(db, serial_number, sync=False))
+            except Exception:
+                # a deleted pass or failed photo download only drops that pass from the batch
+                db.rollback()
+                logger.exception('Google pass render failed for pass (' + serial_number + ')')
+        failed = utils.batch_sync_google(db, google_passes)
+        if failed:
+            logger.error('Google sync failed for passes (' + ', '.join(failed) + ')')
+    finally:
+        db.close()
+
+def dispatch(serial_number: str, google_sync: bool = True):
+    '''
+    Starts both lanes for a pass whose database row changed
+    '''
+    apple.submit(serial_number, build_apple_pass, serial_number)
+    if google_sync:
+        google.submit(serial_number, build_google_pass, serial_number)
+
+def dispatch_google_batch(serial_numbers: list):
+    '''
+    Starts the Google lane for many passes at once
+    '''
+    if serial_numbers:
+        google.submit(None, build_google_batch, list(serial_numbers))
+
+def stats():
+    return {'apple': apple.stats(), 'google': google.stats()}
+
+def shutdown():
+    apple.shutdown()
+    google.shutdown()
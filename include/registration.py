@@ -0,0 +1,174 @@
+'''
+registration.py: Background registration jobs polled by the success page.
+submit() only queues the OC validation, pkpass build & Google save link, so the
+browser gets its page right away. A resubmitted form attaches to the job already
+running for that ID instead of starting the work again.
+'''
+
+import hmac, hashlib, logging, secrets, threading
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import config, include.crud as crud, include.schemas as schemas
+from include.cache import LRUCache
+from include.database import SessionLocal
+from include.pipeline import Lane
+
+logger = logging.getLogger('app')
+
+# every worker must share the secret to answer polls for jobs started by another worker,
+# without REGISTRATION_SECRET it is generated once & kept in the database
+keys = dict()
+
+def secret():
+    if 'registration' not in keys:
+        value = config.REGISTRATION_SECRET
+        if not value:
+            db = SessionLocal()
+            try:
+                value = crud.get_shared_secret(db, 'registration')
+            finally:
+                db.close()
+        keys['registration'] = value.encode('utf-8')
+    return keys['registration']
+
+def sign(id_num: str, nonce: str, id_pin: str):
+    return hmac.new(secret(), '.'.join([id_num, nonce, id_pin]).encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+class Job():
+    '''
+    Progress of one registration, the Apple & Google artifacts are ready independently
+    '''
+    def __init__(self, id_num: str, id_pin: str):
+        nonce = secrets.token_urlsafe(12)
+        # the id proves the pin was known, so only the user can poll the pass_hash
+        self.id = '.'.join([id_num, nonce, sign(id_num, nonce, id_pin)])
+        self.id_num = id_num
+        self.id_pin = id_pin
+        self.state = 'pending' # pending, ready, invalid or failed
+        self.pass_hash = None # set once the pkpass can be downloaded
+        self.save_link = None # set once the Google save link is signed
+
+    def status(self):
+        return {'state': self.state, 'pass_hash': self.pass_hash, 'save_link': self.save_link}
+
+jobs = LRUCache(config.REGISTRATION_JOB_CACHE_SIZE, config.REGISTRATION_JOB_TTL)
+in_flight = dict() # id_num -> Job still running
+lock = threading.Lock()
+lane = Lane('registration', config.REGISTRATION_LANE_WORKERS)
+counts = {'started': 0, 'attached': 0}
+
+def submit(id_num: str, id_pin: str):
+    '''
+    Starts a registration or attaches to the one running for the same ID & pin, returns the job id
+    '''
+    with lock:
+        job = in_flight.get(id_num)
+        if job and hmac.compare_digest(job.id_pin, id_pin):
+            counts['attached'] += 1
+            return job.id
+        job = Job(id_num, id_pin)
+        in_flight.setdefault(id_num, job)
+        counts['started'] += 1
+    jobs.set(job.id, job)
+    lane.submit(None, run, job)
+    return job.id
+
+def finish(db: Session, job: Job, state: str):
+    '''
+    Ends a job, the state is kept in the database for polls answered by other workers
+    '''
+    try:
+        crud.finish_registration_job(db, job.id, state)
+    except Exception:
+        db.rollback()
+        logger.exception('Could not record registration state for ID (' + job.id_num + ')')
+    job.state = state
+
+def run(job: Job):
+    db = SessionLocal()
+    try:
+        build(db, job)
+    except Exception:
+        db.rollback()
+        logger.exception('Registration failed for ID (' + job.id_num + ')')
+        finish(db, job, 'failed')
+    finally:
+        db.close()
+        with lock:
+            if in_flight.get(job.id_num) is job:
+                del in_flight[job.id_num]
+
+def build(db: Session, job: Job):
+    db_pass = crud.get_pass(db, job.id_num)
+    created = False
+    if not db_pass:
+        # if pass for user does not exist,
+        # check for vaild User though OC
+        user = schemas.User(job.id_num, job.id_pin)
+        if not user.is_valid():
+            finish(db, job, 'invalid')
+            logger.debug('Registration unsuccessful for ID (' + job.id_num + ')')
+            return
+        try:
+            db_pass = crud.add_pass(db, user)
+            created = True
+            logger.info('Pass created for ID (' + job.id_num + ')')
+        except IntegrityError:
+            # another worker registered the same ID first
+            db.rollback()
+            db_pass = crud.get_pass(db, job.id_num)
+
+    if not hmac.compare_digest(str(db_pass.id_pin), job.id_pin):
+        finish(db, job, 'invalid')
+        logger.debug('Registration unsuccessful for ID (' + job.id_num + ')')
+        return
+
+    if created or not db_pass.pkpass_key:
+        schemas.Pkpass(db, db_pass.serial_number)
+    # Add to Apple Wallet button can be shown
+    job.pass_hash = db_pass.pass_hash
+
+    try:
+        job.save_link = schemas.JWT.get_save_link(db, db_pass)
+    except Exception:
+        # the Apple pass still works, ready with no save link means Google is unavailable
+        db.rollback()
+        logger.exception('Google save link failed for ID (' + job.id_num + ')')
+    finish(db, job, 'ready')
+    logger.info('Registration ready for ID (' + job.id_num + ')')
+
+def status(db: Session, job_id: str):
+    '''
+    Progress of a job, read from the database if it runs in another worker
+    '''
+    job = jobs.get(job_id)
+    if job:
+        return job.status()
+
+    finished = crud.get_registration_job_state(db, job_id)
+    if finished in ('invalid', 'failed'):
+        return {'state': finished}
+    parts = job_id.split('.')
+    if len(parts) != 3:
+        return {'state': 'unknown'}
+    id_num, nonce, mac = parts
+    db_pass = crud.get_pass(db, id_num)
+    if not db_pass:
+        # not created yet
+        return {'state': 'pending'}
+    if not hmac.compare_digest(sign(id_num, nonce, str(db_pass.id_pin)), mac):
+        return {'state': 'invalid'}
+
+    pass_hash = db_pass.pass_hash if db_pass.pkpass_key else None
+    save_link = schemas.JWT.get_save_link(db, db_pass, render=False)
+    # ready without a save link means Google was unavailable
+    state = 'ready' if finished == 'ready' or (pass_hash and save_link) else 'pending'
+    return {'state': state, 'pass_hash': pass_hash, 'save_link': save_link}
+
+def stats():
+    return dict(counts, in_flight=len(in_flight), jobs=len(jobs), lane=lane.stats())
+
+def shutdown():
+    lane.shutdown()
@@ -0,0 +1,112 @@
+'''
+scanlog.py: Buffered writer for the append-only scan event table.
+Scans are queued in memory and a single thread commits them in batches,
+so recording a scan never adds a database write to the scan request.
+'''
+
+import logging, queue, threading, time
+from datetime import datetime, timedelta, timezone
+
+import config, include.crud as crud
+from include.database import SessionLocal
+
+logger = logging.getLogger('app')
+
+EPOCH = datetime(1970, 1, 1) # scan times are naive UTC like the rest of the database
+
+def utc(value: datetime):
+    '''
+    Naive UTC datetime of value, which is naive UTC already or timezone aware
+    '''
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def bucket_of(scanned_at: datetime):
+    '''
+    Start of the rollup bucket a scan (naive UTC) falls in
+    '''
+    seconds = int((scanned_at - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % config.SCAN_ROLLUP_BUCKET)
+
+class ScanWriter():
+    '''
+    Queue of scan events drained by one writer thread
+    '''
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=config.SCAN_LOG_QUEUE_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.counts = {'recorded': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'failed': 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='scanlog', daemon=True)
+                self.thread.start()
+
+    def record(self, serial_number: str, reader: str, scanned_at: float = None):
+        '''
+        Queues a scan without blocking, drops it if the writer has fallen too far behind
+        '''
+        if self.thread is None:
+            self.start()
+        scanned_at = datetime.utcfromtimestamp(scanned_at) if scanned_at else datetime.utcnow()
+        event = {'scanned_at': scanned_at, 'bucket': bucket_of(scanned_at), 'reader': reader or '', \
+            'serial_number': serial_number, 'accepted': serial_number is not None}
+        try:
+            self.queue.put_nowait(event)
+            self.counts['recorded'] += 1
+        except queue.Full:
+            self.counts['dropped'] += 1
+
+    def take_batch(self):
+        '''
+        Waits for the first event, then gathers what arrives within SCAN_LOG_FLUSH_INTERVAL
+        '''
+        try:
+            events = [self.queue.get(timeout=config.SCAN_LOG_FLUSH_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + config.SCAN_LOG_FLUSH_INTERVAL
+        while len(events) < config.SCAN_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                events.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def write(self, events: list):
+        db = SessionLocal()
+        try:
+            crud.add_scan_events(db, events)
+            self.counts['written'] += len(events)
+            self.counts['batches'] += 1
+        except Exception:
+            # the events are lost, scanning must go on
+            db.rollback()
+            self.counts['failed'] += len(events)
+            logger.exception('Writing ' + str(len(events)) + ' scan events failed')
+        finally:
+            db.close()
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            events = self.take_batch()
+            if events:
+                self.write(events)
+
+    def stats(self):
+        return dict(self.counts, queued=self.queue.qsize())
+
+    def shutdown(self):
+        '''
+        Writes the events still queued
+        '''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=config.SCAN_LOG_FLUSH_INTERVAL * 10)
+
+writer = ScanWriter()
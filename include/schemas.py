@@ -9,13 +9,19 @@ from datetime import datetime, timedelta
 import pytz
 
 from sqlalchemy.orm import Session
-import include.crud as crud, include.utils as utils, config
+import include.crud as crud, include.utils as utils, include.barcode as barcode, include.storage as storage, config
+from include.cache import LRUCache
 # Apple
 from include.apple.passkit import Pass, Barcode, Generic, BarcodeFormat, Alignment, Location, IBeacon
 # Google
 import include.google.services as services
 import include.google.restMethods
 
+# (serial_number, last_update) -> signed Google save link
+save_links = LRUCache(config.SAVE_LINK_CACHE_SIZE, config.SAVE_LINK_CACHE_TTL)
+# serial_number -> (pkpass_key, pkpass bytes) of passes built by this worker
+pkpass_files = LRUCache(config.PKPASS_CACHE_SIZE)
+
 class User():
     '''
     Check for valid users
@@ -96,6 +102,7 @@ class Pkpass():
     def __init__(self, db: Session, serial_number: str):
         # parse User data into reusable variables
         user_pass = crud.get_pass(db, serial_number)
+        built_from = user_pass.last_update
 
         passinfo = Generic()
         passinfo.addPrimaryField('name', user_pass.name)
@@ -127,7 +134,11 @@ class Pkpass():
         passfile.backgroundColor = 'rgb(128, 20, 41)'
         passfile.labelColor = 'rgb(255, 255, 255)'
         passfile.serialNumber = user_pass.serial_number
-        passfile.barcode = Barcode(user_pass.pass_hash, BarcodeFormat.QR, user_pass.serial_number)   
+        if barcode.enabled():
+            # verified without a lookup, so scans don't rebuild the pass
+            passfile.barcode = Barcode(barcode.apple_message(user_pass.serial_number), BarcodeFormat.QR, user_pass.serial_number)
+        else:
+            passfile.barcode = Barcode(user_pass.pass_hash, BarcodeFormat.QR, user_pass.serial_number)
         passfile.locations = list()
         passfile.locations.append(Location(35.611219, -97.467255, relevantText='Welcome to Garvey! Tap to scan your ID.', maxDistance=20))
         passfile.locations.append(Location(35.6115, -97.4695, relevantText='Welcome to the Branch! Tap to scan your ID.', maxDistance=20))
@@ -173,13 +184,18 @@ class Pkpass():
             passfile.addFile('thumbnail@3x.png', open('base.pass/thumbnail@3x.png', 'rb'))
 
         # Create and output the Passbook file (.pkpass)
-        passfile.create(config.PASS_TYPE_CERTIFICATE_PATH, config.PASS_TYPE_CERTIFICATE_PATH, config.WWDR_CERTIFICATE_PATH, config.PEM_PASSWORD, 'passes/' + user_pass.serial_number + '.pkpass')
+        pkpass = passfile.create(config.PASS_TYPE_CERTIFICATE_PATH, config.PASS_TYPE_CERTIFICATE_PATH, config.WWDR_CERTIFICATE_PATH, config.PEM_PASSWORD).getvalue()
+        pkpass_key = storage.store.put(pkpass)
+        # the pass row points at the new blob & its validators for conditional requests
+        crud.set_pkpass(db, serial_number, pkpass_key, passfile.manifestHash, built_from)
+        # devices fetch the pass right after its update is pushed
+        pkpass_files.set(serial_number, (pkpass_key, pkpass))
 
 class JWT():
     '''
     Google Pass Object
     '''
-    def __init__(self, db: Session, serial_number: str):
+    def __init__(self, db: Session, serial_number: str, sync: bool = True):
         # parse User data into reusable variables
         user_pass = crud.get_pass(db, serial_number)
 
@@ -194,12 +210,55 @@ class JWT():
         font = ImageFont.truetype("include/google/Roboto-Regular.ttf", 34)
         draw.text((37, 84), user_pass.name, (255, 255, 255), font=font)
 
-        hero_image.save('static/heroImg/' + serial_number + '.png')
+        hero_bytes = BytesIO()
+        hero_image.save(hero_bytes, format='PNG')
+        # the key changes only when the rendered image does
+        hero_image_version = storage.store.put(hero_bytes.getvalue())
+        crud.set_hero_key(db, serial_number, hero_image_version)
 
-        objectUid = str(services.VerticalType.LOYALTY).split('.')[1] + '_OBJECT_' + str(serial_number)
-        # check Reference API for format of "id" (https://developers.google.com/pay/passes/reference/v1/).
-        objectId = '%s.%s' % (config.ISSUER_ID, objectUid)
-        self.objectJwt = services.makeSkinnyJwt(services.VerticalType.LOYALTY, config.CLASS_ID, objectId, user_pass)
+        self.serial_number = serial_number
+        self.hero_image_version = hero_image_version
+        self.objectJwt = None
+        if sync:
+            # sync object now, otherwise the caller batches it with others
+            objectId = services.makeObjectId(services.VerticalType.LOYALTY, serial_number)
+            self.objectJwt = services.makeSkinnyJwt(db, services.VerticalType.LOYALTY, config.CLASS_ID, objectId, user_pass, hero_image_version)
+            save_links.set((serial_number, user_pass.last_update), self.get_link())
 
     def get_link(self):
-        return config.SAVE_LINK + self.objectJwt.decode('UTF-8')
\ No newline at end of file
+        if self.objectJwt:
+            return config.SAVE_LINK + self.objectJwt.decode('UTF-8')
+
+    @staticmethod
+    def get_save_link(db: Session, user_pass, render: bool = True):
+        '''
+        Save link for the current version of a pass, signed once per version
+        Without render, returns None instead of rendering & syncing the Google pass
+        '''
+        version = (user_pass.serial_number, user_pass.last_update)
+        link = save_links.get(version)
+        if link:
+            return link
+
+        objectId = services.makeObjectId(services.VerticalType.LOYALTY, user_pass.serial_number)
+        if crud.get_google_object(db, user_pass.serial_number):
+            # object is already synced, only the signature is needed
+            link = config.SAVE_LINK + services.signObjectJwt(services.VerticalType.LOYALTY, objectId).decode('UTF-8')
+        elif config.GOOGLE_JWT_MODE == 'fat':
+            # sign the object into the link locally,
+            # the hero image and REST sync can happen afterwards
+            signedJwt = services.makeFatJwt(services.VerticalType.LOYALTY, config.CLASS_ID, objectId, user_pass)
+            if signedJwt:
+                link = config.SAVE_LINK + signedJwt.decode('UTF-8')
+                if config.GOOGLE_FAT_JWT_SYNC:
+                    # queued on the Google lane, the link doesn't wait for it
+                    utils.sync_google_pass(user_pass.serial_number)
+
+        if not link:
+            if not render:
+                return None
+            # render and sync the Google pass, which caches its link
+            return JWT(db, user_pass.serial_number).get_link()
+
+        save_links.set(version, link)
+        return link
\ No newline at end of file
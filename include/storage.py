@@ -0,0 +1,215 @@
+'''
+storage.py: Content addressed blob store for built passes & hero images.
+The key of a blob is the sha256 of its bytes, so an identical artifact is stored
+once and a key never points at different bytes. The local backend shards files
+into key[:2]/key[2:4]/ directories, the S3 backend works with any S3 compatible
+service (boto3 is only needed when BLOB_STORE is 's3').
+'''
+
+import hashlib, os, re, tempfile, threading
+
+import config
+
+CHUNK_SIZE = 64 * 1024 # bytes read & written at a time
+SPOOL_SIZE = 1024 * 1024 # bytes of an upload kept in memory before spilling to disk
+KEY_PATTERN = re.compile('[0-9a-f]{64}')
+
+def valid_key(key):
+    return bool(key) and KEY_PATTERN.fullmatch(key) is not None
+
+def missing(err: Exception):
+    # error of the S3 API for a key that doesn't exist
+    return getattr(err, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+def chunks(data):
+    '''
+    Yields the bytes of data, which is bytes or a readable binary file
+    '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        yield bytes(data)
+        return
+    while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+class BlobStore():
+    '''
+    Interface of the backends, put() returns the key to read the blob with
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'puts': 0, 'deduplicated': 0, 'bytes_written': 0, 'reads': 0, 'deletes': 0}
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def put(self, data):
+        raise NotImplementedError
+
+    def exists(self, key: str):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        '''
+        Removes a blob, nothing happens if it doesn't exist
+        '''
+        raise NotImplementedError
+
+    def stream(self, key: str):
+        '''
+        Returns (iterator of chunks, size) of a blob, raises FileNotFoundError if it doesn't exist
+        '''
+        raise NotImplementedError
+
+    def path(self, key: str):
+        '''
+        Local file of a blob, None if the backend has no files
+        '''
+        return None
+
+    def read(self, key: str):
+        blob, size = self.stream(key)
+        return b''.join(blob)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, backend=type(self).__name__)
+
+class LocalBlobStore(BlobStore):
+    '''
+    Blobs in sharded directories of a local (or shared) filesystem
+    '''
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def relative_path(self, key: str):
+        if not valid_key(key):
+            raise FileNotFoundError(key)
+        return key[:2] + '/' + key[2:4] + '/' + key
+
+    def path(self, key: str):
+        return os.path.join(self.root, self.relative_path(key))
+
+    def put(self, data):
+        # hashed while written, then moved into place in one step
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in chunks(data):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+            key = digest.hexdigest()
+            path = self.path(key)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                self.count('deduplicated')
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                self.count('bytes_written', size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.count('puts')
+        return key
+
+    def exists(self, key: str):
+        return valid_key(key) and os.path.exists(self.path(key))
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            return
+        self.count('deletes')
+
+    def stream(self, key: str):
+        blob_file = open(self.path(key), 'rb')
+        size = os.fstat(blob_file.fileno()).st_size
+        self.count('reads')
+
+        def read_chunks():
+            with blob_file:
+                yield from chunks(blob_file)
+        return read_chunks(), size
+
+class S3BlobStore(BlobStore):
+    '''
+    Blobs in an S3 compatible bucket, e.g. AWS S3 or MinIO
+    '''
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str = None, client=None):
+        super().__init__()
+        if client is None:
+            import boto3 # only needed for this backend
+            client = boto3.client('s3', endpoint_url=endpoint_url or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key: str):
+        if not valid_key(key):
+            raise FileNotFoundError(key)
+        return self.prefix + key[:2] + '/' + key[2:4] + '/' + key
+
+    def put(self, data):
+        # the key is only known once every byte is hashed
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in chunks(data):
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            key = digest.hexdigest()
+            if self.exists(key):
+                self.count('deduplicated')
+            else:
+                spool.seek(0)
+                self.client.upload_fileobj(spool, self.bucket, self.object_key(key))
+                self.count('bytes_written', size)
+        self.count('puts')
+        return key
+
+    def exists(self, key: str):
+        if not valid_key(key):
+            return False
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as err:
+            if missing(err):
+                return False
+            raise
+        return True
+
+    def delete(self, key: str):
+        if valid_key(key):
+            # S3 deletes of a missing key succeed too
+            self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+            self.count('deletes')
+
+    def stream(self, key: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as err:
+            if missing(err):
+                raise FileNotFoundError(key)
+            raise
+        self.count('reads')
+        return response['Body'].iter_chunks(CHUNK_SIZE), response['ContentLength']
+
+def make_store():
+    if config.BLOB_STORE == 's3':
+        return S3BlobStore(config.BLOB_S3_BUCKET, config.BLOB_S3_PREFIX, config.BLOB_S3_ENDPOINT)
+    return LocalBlobStore(config.BLOB_ROOT)
+
+store = make_store()
@@ -1,18 +1,21 @@
 '''
 utils.py: Reusable functions to interact with the main program.
 '''
-import secrets, sys, base64, smtplib, ssl
-from datetime import datetime
+import secrets, sys, base64, smtplib, ssl, time, os
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
 
 from sqlalchemy.orm import Session
-from fastapi.responses import FileResponse
+from fastapi import Response
+from fastapi.responses import FileResponse, StreamingResponse
 from apns2.client import APNsClient
 from apns2.payload import Payload
 from hashlib import md5
 from Cryptodome import Random
 from Cryptodome.Cipher import AES
 
-import config, include.crud as crud, include.schemas as schemas
+import config, include.crud as crud, include.schemas as schemas, include.pipeline as pipeline, include.passindex as passindex, include.devicelists as devicelists, include.barcode as barcode, include.scanlog as scanlog, include.offload as offload, include.bulkhead as bulkhead, include.registration as registration, include.database as database, include.storage as storage, include.migrations as migrations
+import include.google.services as services, include.google.restMethods as restMethods
 
 class AES256():
     '''
@@ -108,41 +111,236 @@ def input_validate(id: str, pin: str):
     
     return valid
 
-def unique_pass_hash(db: Session, num_bytes: int):
+def new_pass_hash(num_bytes: int = 32):
     '''
-    Makes sure hash is unique in the database
+    Random pass_hash, uniqueness is enforced by the unique index & a retry on conflict
     '''
-    unique = False
-    while(not unique):
-        hash = secrets.token_urlsafe(num_bytes)
+    return secrets.token_urlsafe(num_bytes)
 
-        db_pass = crud.get_pass_by_hash(db, hash)
-        if not db_pass: # no pass has hash therefor unique
-            unique = True
+# pkpass files served, by where the bytes came from
+pkpass_served = {'memory': 0, 'memory_bytes': 0, 'store': 0, 'store_bytes': 0, 'redirected': 0, 'legacy': 0}
 
-    return hash
+def get_pass_file(db: Session, row):
+    '''
+    Gets the pass file associated with the given pass row, with its validators
+    '''
+    headers = pass_headers(row)
+    headers['Content-Disposition'] = 'attachment; filename="ocid.pkpass"'
+    if not row.pkpass_key:
+        # built before the blob store & not imported yet, or never built
+        pkpass_served['legacy'] += 1
+        return legacy_response(migrations.LEGACY_PKPASS.format(row.serial_number), 'application/vnd.apple.pkpass', headers)
+    cached = schemas.pkpass_files.get(row.serial_number)
+    if cached and cached[0] == row.pkpass_key:
+        # built by this worker & still current
+        pkpass_served['memory'] += 1
+        pkpass_served['memory_bytes'] += len(cached[1])
+        return Response(cached[1], media_type='application/vnd.apple.pkpass', headers=headers)
+
+    if config.PKPASS_ACCEL_REDIRECT and isinstance(storage.store, storage.LocalBlobStore):
+        # nginx sends the file itself with sendfile
+        pkpass_served['redirected'] += 1
+        headers['X-Accel-Redirect'] = config.PKPASS_ACCEL_REDIRECT + storage.store.relative_path(row.pkpass_key)
+        return Response(media_type='application/vnd.apple.pkpass', headers=headers)
+
+    try:
+        response = blob_response(row.pkpass_key, 'application/vnd.apple.pkpass', headers)
+    except FileNotFoundError:
+        # the blob was removed from the store
+        return Response(status_code=404)
+    pkpass_served['store'] += 1
+    pkpass_served['store_bytes'] += int(response.headers.get('content-length', 0))
+    return response
+
+def blob_response(key: str, media_type: str, headers: dict = None):
+    '''
+    Sends a blob from the store, local blobs as files & others streamed in chunks
+    '''
+    headers = dict(headers or {})
+    path = storage.store.path(key)
+    if path:
+        storage.store.count('reads')
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=os.stat(path))
+    blob, size = storage.store.stream(key)
+    headers['Content-Length'] = str(size)
+    return StreamingResponse(blob, media_type=media_type, headers=headers)
+
+def legacy_response(path: str, media_type: str, headers: dict = None):
+    '''
+    Sends a file written before the blob store, 404 if there is none
+    '''
+    if not os.path.exists(path):
+        return Response(status_code=404)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+def pkpass_stats():
+    with schemas.pkpass_files.lock:
+        cached_bytes = sum(len(entry[1][1]) for entry in schemas.pkpass_files.data.values())
+    return dict(schemas.pkpass_files.stats(), cached_bytes=cached_bytes, served=dict(pkpass_served))
 
-def get_pass_file(db: Session, serial_number: str):
+def last_modified(row):
     '''
-    Gets the pass file associated with the given serial_number
+    Time the Last-Modified validator of a pass is sent from & compared with
     '''
-    return FileResponse('passes/' + serial_number + '.pkpass', media_type='application/vnd.apple.pkpass', filename='ocid.pkpass')
+    modified = row.built_at or row.last_update
+    # HTTP dates have second precision
+    return modified.replace(microsecond=0) if modified else None
+
+def pass_headers(row):
+    '''
+    ETag & Last-Modified of the built pkpass, from the database so no file is touched
+    '''
+    headers = dict()
+    if row.etag:
+        headers['ETag'] = '"' + row.etag + '"'
+    modified = last_modified(row)
+    if modified:
+        headers['Last-Modified'] = formatdate(modified.replace(tzinfo=timezone.utc).timestamp(), usegmt=True)
+    return headers
+
+def not_modified(headers, row):
+    '''
+    Returns a 304 response if the client's copy of the pass is current, otherwise None
+    '''
+    if_none_match = headers.get('if-none-match')
+    if if_none_match:
+        # takes precedence over If-Modified-Since
+        tags = [tag.strip().replace('W/', '', 1).strip('"') for tag in if_none_match.split(',')]
+        if not (row.etag and ('*' in tags or row.etag in tags)):
+            return None
+    else:
+        if_modified_since = headers.get('if-modified-since')
+        modified = last_modified(row)
+        if not if_modified_since or not modified:
+            return None
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            # unparseable dates are ignored
+            return None
+        if since.tzinfo:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # the same time Last-Modified was sent from
+        if modified > since:
+            return None
+    return Response(status_code=304, headers=pass_headers(row))
+
+def scan_pass(db: Session, message: str, scanned_at: float = None, reader: str = None):
+    '''
+    Converts scanned barcode data to (serial_number, rotate), rotate is True if the pass needs a new barcode
+    '''
+    if barcode.enabled():
+        # verified without a pass lookup, Apple passes are only rebuilt when their barcode nears expiry
+        token = barcode.verify(db, message, scanned_at, reader)
+        serial_number = token.serial_number if token else None
+        rotate = token is not None and barcode.stale(token)
+    else:
+        # a pass_hash is single use, so every scan rotates it
+        serial_number = passindex.index.lookup(db, message)
+        rotate = serial_number is not None
 
-def force_pass_update(db: Session, serial_number: str):
-    crud.update_hash(db, serial_number)
-    push_pass_update(db, serial_number)
+    scanlog.writer.record(serial_number, reader, scanned_at)
+    return serial_number, rotate
 
-def update_pass(db: Session, serial_number: str):
+def scan_batch(db: Session, scans: list, reader: str = None):
     '''
-    Updates pass with serial_number
+    Converts many scans to per-item results, returns (results, serial_numbers to rotate)
+    Each scan is a dict with 'hash' and optional 'reader', 'timestamp' & 'id',
+    a malformed scan gets an 'error' in its result without failing the others
+    '''
+    results = list()
+    rotate = list()
+    now = time.time()
+    for scan in scans:
+        if not isinstance(scan, dict):
+            results.append({'id': None, 'hash': None, 'serial_number': None, 'error': 'expected a scan object'})
+            continue
+        result = {'id': scan.get('id'), 'hash': scan.get('hash'), 'serial_number': None}
+        message = scan.get('hash')
+        scanned_at = scan.get('timestamp')
+        if isinstance(message, str) and (scanned_at is None or isinstance(scanned_at, (int, float))):
+            if scanned_at is not None and scanned_at > now:
+                # a reader clock ahead of the server counts as now
+                scanned_at = now
+            serial_number, rotate_pass = scan_pass(db, message, scanned_at, scan.get('reader') or reader)
+            result['serial_number'] = serial_number
+            if rotate_pass and serial_number not in rotate:
+                rotate.append(serial_number)
+        else:
+            result['error'] = 'expected a string hash and a numeric timestamp'
+        results.append(result)
+    return results, rotate
+
+def rotate_passes(db: Session, serial_numbers: list):
+    '''
+    Gives scanned passes new barcodes outside of the request that scanned them
+    '''
+    crud.bulk_rotate_hashes(db, serial_numbers)
+    for serial_number in serial_numbers:
+        # rebuild & push the Apple pass and sync the Google pass independently
+        pipeline.dispatch(serial_number)
+
+def update_pass(db: Session, serial_number: str, google_sync: bool = True):
+    '''
+    Updates pass with serial_number, returns if the user was valid
     '''
     user = schemas.User(serial_number)
     if user.is_valid():
         # if user is valid,
         # update database pass
         crud.update_db_pass(db, user)
-        # start background task to update pass with new pass_hash
-        push_pass_update(db, serial_number)
+        # rebuild & push the Apple pass and sync the Google pass independently
+        pipeline.dispatch(serial_number, google_sync)
+        return True
+    return False
+
+def batch_update_passes(db: Session, serial_numbers: list):
+    '''
+    Updates a chunk of passes in one transaction, returns the serial_numbers of valid users
+    '''
+    users = list()
+    for serial_number in serial_numbers:
+        user = schemas.User(serial_number)
+        if user.is_valid():
+            users.append(user)
+    crud.bulk_update_passes(db, users)
+    for user in users:
+        # rebuild & push the Apple passes, Google objects are synced in batches
+        pipeline.dispatch(user.id, google_sync=False)
+    return [user.id for user in users]
+
+def sync_google_pass(serial_number: str):
+    '''
+    Renders and syncs a Google pass outside of the request that linked it
+    '''
+    pipeline.google.submit(serial_number, pipeline.build_google_pass, serial_number)
+
+def batch_sync_google(db: Session, google_passes: list):
+    '''
+    Syncs rendered Google passes in batch requests, returns the serial_numbers that failed
+    '''
+    items = list()
+    for google in google_passes:
+        user_pass = crud.get_pass(db, google.serial_number)
+        if user_pass is None:
+            # deleted since it was rendered
+            continue
+        items.append((user_pass, google.hero_image_version))
+    results = services.batchSyncObjects(db, services.VerticalType.LOYALTY, config.CLASS_ID, items)
+
+    return [serial_number for serial_number, result in results.items() if result == 'failed']
+
+def provision_google_class(db: Session, force: bool = False):
+    '''
+    Inserts or updates the Google Pay class when its definition has changed
+    '''
+    return services.provisionClass(db, services.VerticalType.LOYALTY, config.CLASS_ID, force)
+
+def get_stats():
+    '''
+    Collects the counters reported by the server
+    '''
+    return {'google': restMethods.getStats(), 'save_links': schemas.save_links.stats(), 'pkpass_files': pkpass_stats(), 'blob_store': storage.store.stats(), 'lanes': pipeline.stats(), 'pass_rows': crud.pass_rows.stats(), 'scan_index': passindex.index.stats(), 'device_lists': devicelists.lists.stats(), 'barcodes': barcode.stats(), 'scan_log': scanlog.writer.stats(), 'event_loop': offload.watchdog.stats(), 'bulkheads': bulkhead.stats(), 'registration': registration.stats(), 'database': database.pool_stats()}
 
 def push_pass_update(db: Session, serial_number: str):
     push_tokens = crud.get_device_list_by_pass(db, serial_number)
@@ -8,20 +8,21 @@ __maintainer__ = "Andrew Siemer"
 __email__ = "andrew.siemer@eagles.oc.edu"
 __status__ = "Production"
 
-import threading, logging # standard library
+import threading, logging, json # standard library
 from datetime import datetime, timedelta 
-from typing import Optional
+from typing import Optional, List, Any
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from fastapi import FastAPI, Header, Request, Response, status, Depends, BackgroundTasks, Form # 3rd party packages
+from fastapi import FastAPI, Header, Request, Response, status, Depends, BackgroundTasks, Form, WebSocket, WebSocketDisconnect # 3rd party packages
 from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from apscheduler.schedulers.background import BackgroundScheduler
 
-import include.crud as crud, include.utils as utils, include.models as models, include.schemas as schemas, config # local imports
+import include.crud as crud, include.utils as utils, include.models as models, include.pipeline as pipeline, include.passindex as passindex, include.scanlog as scanlog, include.offload as offload, include.bulkhead as bulkhead, include.registration as registration, include.migrations as migrations, config # local imports
 from include.database import SessionLocal, engine
+import include.database as database
 
 LOG_FILE = 'app.log'
 logger = logging.getLogger('app')
@@ -52,6 +53,7 @@ else:
     app = FastAPI(docs_url=None,redoc_url=None)
 
 models.Base.metadata.create_all(bind=engine)
+migrations.migrate(engine)
 
 def get_db():
     '''
@@ -68,7 +70,8 @@ PassKit Web Service
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
 @app.post("/v1/devices/{device_id}/registrations/{pass_type}/{serial_number}", tags=["PassKit"])
-def register(request: Request, body: dict, device_id: str, pass_type: str, serial_number: str, db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.device)
+def register(request: Request, body: dict, device_id: str, pass_type: str, serial_number: str, db: Session = None):
     '''
     Registering a Device to Receive Push Notifications for a Pass
     '''
@@ -77,15 +80,12 @@ def register(request: Request, body: dict, device_id: str, pass_type: str, seria
     push_token = str(body['pushToken'])
 
     logger.debug('Pass registration request from device (' + device_id + ')')
-    if crud.get_pass(db, serial_number, auth_token):
+    if crud.get_authorized_pass(db, serial_number, auth_token):
         # if pass exists in database with same serial number & matching auth_token
-        if not crud.get_device(db, device_id): 
-            # if no device with same device_id exists
-            crud.add_device(db, device_id, push_token)
-        if not crud.get_registration(db, device_id, serial_number): 
-            # if the device is not already registered
+        # add or update the device & register it for the pass in one transaction
+        if crud.register_device(db, device_id, push_token, serial_number):
+            # if the device was not already registered
             # for a pass with same serial_number
-            crud.add_registration(db, device_id, serial_number)
             # if registration succeeds, returns HTTP status 201.
             response = Response(status_code=201)
             logger.info('New user registered (' + serial_number + ')')
@@ -102,29 +102,23 @@ def register(request: Request, body: dict, device_id: str, pass_type: str, seria
     return response
 
 @app.get("/v1/devices/{device_id}/registrations/{pass_type}", status_code=200, tags=["PassKit"])
-def get_passes(request: Request, device_id: str, pass_type: str, passesUpdatedSince: str = None, db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.device)
+def get_passes(request: Request, device_id: str, pass_type: str, passesUpdatedSince: str = None, db: Session = None):
     '''
     Getting the Serial Numbers for Passes Associated with a Device
     '''
 
     logger.debug('Device (' + device_id + ') asked for list of registered passes')
-    if crud.get_registration_by_device(db, device_id):
-        # if there is a registration for the device, 
-        # get the serial numbers registered for & 
-        # only get passesUpdatedSince if tag is present in request     
-        last_updated, serial_numbers = crud.get_pass_list_by_device(db, device_id, passesUpdatedSince)
-        if serial_numbers:
-            # if there were matching passes, returns HTTP status 200
-            # with a JSON dictionary with the following keys and value
-            response = {'lastUpdated': str(last_updated), 'serialNumbers': serial_numbers}
-            logger.debug('Device (' + device_id + ') with registrations (' + str(serial_numbers) + ') was last updated at ' + str(last_updated))
-        else:
-            # if there are no matching passes, 
-            # returns HTTP status 204
-            response = Response(status_code=204)
-            logger.debug('Device (' + device_id + ') has no current registrations')
+    # get the serial numbers registered for the device from memory & 
+    # only get passesUpdatedSince if tag is present in request     
+    last_updated, serial_numbers = crud.get_pass_list_by_device(db, device_id, passesUpdatedSince)
+    if serial_numbers:
+        # if there were matching passes, returns HTTP status 200
+        # with a JSON dictionary with the following keys and value
+        response = {'lastUpdated': str(last_updated), 'serialNumbers': serial_numbers}
+        logger.debug('Device (' + device_id + ') with registrations (' + str(serial_numbers) + ') was last updated at ' + str(last_updated))
     else:
-        # if there are no matching passes, 
+        # if there are no registrations or matching passes, 
         # returns HTTP status 204
         response = Response(status_code=204)
         logger.debug('Device (' + device_id + ') has no current registrations')
@@ -132,38 +126,28 @@ def get_passes(request: Request, device_id: str, pass_type: str, passesUpdatedSi
     return response
 
 @app.get("/v1/passes/{pass_type}/{serial_number}", status_code=200, tags=["PassKit"])
-def send_passes(request: Request, pass_type: str, serial_number: str, db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.device)
+def send_passes(request: Request, pass_type: str, serial_number: str, db: Session = None):
     '''
     Getting the Latest Version of a Pass
     '''
 
     auth_token = str(request.headers.get('Authorization')).replace('ApplePass ', '')
-    if_modified_since = request.headers.get('if-modified-since')        
 
     logger.debug('Device asked for latest version of pass (' + serial_number + ') with authorization (' + auth_token + ')')
 
-    db_pass = crud.get_pass(db, serial_number, auth_token)
+    db_pass = crud.get_authorized_pass(db, serial_number, auth_token)
     if db_pass:
-        # if pass exists and auth_token matches
-        if if_modified_since:
-            # if if_modified_since tag exists, convert to datetime obj to compare
-            if_modified_since = datetime.strptime(if_modified_since,'%a, %d %b %Y %H:%M:%S %Z')
-            # if the pass was updated after if_modified_since,
-            # send the new version of the pass as a response
-            if db_pass.last_update > if_modified_since:
-                # force update on manual database change -> 
-                # crud.force_pass_update(db, db_pass.serial_number)
-                response = utils.get_pass_file(db, db_pass.serial_number)
-                logger.debug('Updated pass (' + serial_number + ') returned to device.')
-            else:
-                # if the pass has not changed, return HTTP status code 304 
-                response = Response(status_code=304)
-                logger.debug('Pass (' + serial_number + ') has not changed.')
+        # if pass exists and auth_token matches,
+        # answer If-None-Match / If-Modified-Since before touching the file
+        response = utils.not_modified(request.headers, db_pass)
+        if response:
+            # if the pass has not changed, return HTTP status code 304
+            logger.debug('Pass (' + serial_number + ') has not changed.')
         else:
-            # if device asks for pass unconditionally,
-            # respond with the current pass file
-            response = utils.get_pass_file(db, db_pass.serial_number)
-            logger.debug('Pass (' + serial_number + ') returned unconditionally')
+            # send the current version of the pass as a response
+            response = utils.get_pass_file(db, db_pass)
+            logger.debug('Pass (' + serial_number + ') returned to device.')
     else:
         # if the request is not authorized, returns HTTP status 401
         response = Response(status_code=401)
@@ -172,7 +156,8 @@ def send_passes(request: Request, pass_type: str, serial_number: str, db: Sessio
     return response
 
 @app.delete("/v1/devices/{device_id}/registrations/{pass_type}/{serial_number}", tags=["PassKit"])
-def delete(request: Request, device_id: str, pass_type: str, serial_number: str, db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.device)
+def delete(request: Request, device_id: str, pass_type: str, serial_number: str, db: Session = None):
     '''
     Unregistering a Device
     '''
@@ -181,15 +166,13 @@ def delete(request: Request, device_id: str, pass_type: str, serial_number: str,
 
     logger.debug('Device (' + device_id + ') deleted pass (' + serial_number + ') with authorization (' + auth_token + ')')
 
-    db_pass = crud.get_pass(db, serial_number, auth_token)
+    db_pass = crud.get_authorized_pass(db, serial_number, auth_token)
     if db_pass:
         # if pass exists and auth_token matches,
         # delete device registration for pass
-        crud.delete_registration(db, device_id, serial_number)
-        if not crud.get_registrations_by_device(db, device_id):
-            # if not more passes exist for device,
-            # delete device and push_token from device table
-            crud.delete_device(db, device_id)
+        # if not more passes exist for device,
+        # delete device and push_token from device table in the same transaction
+        crud.unregister_device(db, device_id, serial_number)
         # if disassociation succeeds, returns HTTP status 200
         response = Response(status_code=200)
         logger.info('Pass (' + serial_number + ') deleted from device (' + device_id + ') ')
@@ -206,6 +189,7 @@ def delete(request: Request, device_id: str, pass_type: str, serial_number: str,
     return response
 
 @app.post("/v1/log", tags=["PassKit"])
+@bulkhead.isolate(bulkhead.device)
 def log(message: dict):
     '''
     Logs Errors from Apple PassKit Service
@@ -220,6 +204,21 @@ def log(message: dict):
 MOBIL-ID Front-End Web Service
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
+@app.get("/static/heroImg/{serial_number}.png", tags=["Registration"])
+def hero_image(serial_number: str, db: Session = Depends(get_db)):
+    '''
+    Google Pay hero image of a pass from the blob store (declared before the static mount)
+    '''
+    # the ?v= version only makes Google fetch the image again
+    hero_key = crud.get_hero_key(db, serial_number)
+    if not hero_key:
+        # rendered before the blob store & not imported yet
+        return utils.legacy_response(migrations.LEGACY_HERO.format(serial_number), 'image/png')
+    try:
+        return utils.blob_response(hero_key, 'image/png')
+    except FileNotFoundError:
+        return Response(status_code=404)
+
 # location of web service static files and html templates
 app.mount('/static', StaticFiles(directory='static'), name='static')
 templates = Jinja2Templates(directory='templates') 
@@ -232,9 +231,10 @@ def root(request: Request):
     return templates.TemplateResponse('index.html', {'request': request})
 
 @app.post("/", tags=["Registration"])
-def submit(request: Request, idNum: str = Form(...), idPin: str = Form(...), db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.registration)
+def submit(request: Request, idNum: str = Form(...), idPin: str = Form(...), db: Session = None):
     '''
-    Login Sumbitted, Validates User & Creates Pass
+    Login Sumbitted, Queues User Validation & Pass Creation
     '''
 
     # get user data from form
@@ -247,42 +247,20 @@ def submit(request: Request, idNum: str = Form(...), idPin: str = Form(...), db:
             # if user form data passes server-side validation,
             # check for existing pass
             db_pass = crud.get_pass(db, entered_id_num)
-            if not db_pass:
-                # if pass for user does not exist,
-                # check for vaild User though OC
-                user = schemas.User(entered_id_num, entered_id_pin)
-                if user.is_valid(): 
-                    # add user_pass to database
-                    db_pass = crud.add_pass(db, user)
-                    # create pass for given user
-                    schemas.Pkpass(db, db_pass.serial_number)
-                    google = schemas.JWT(db, db_pass.serial_number)
-
-                    # respond with success page with Add to Apple Wallet button
-                    response = templates.TemplateResponse('success.html', \
-                        {'request': request, 'pass_hash': db_pass.pass_hash, 'jwt': google.get_link()})
-                    logger.info('Pass created for ID (' + entered_id_num + ')')
-                else:
-                    # user not valid through OC,
-                    # return login page with feedback
-                    del user
-                    response = templates.TemplateResponse('index.html', \
-                        {'request': request, 'feedback': 'The ID Number and ID Card Pin Number entered do not match. Please try again.', 'entered_id': entered_id_num})
-                    logger.debug('Registration unsuccessful for ID (' + entered_id_num + ') with Pin (' +  entered_id_pin + ')')
-            elif db_pass.id_pin == entered_id_pin:
-                google = schemas.JWT(db, db_pass.serial_number)
-
-                # pass for user already exists and login is correct,
-                # respond with success page with Add to Apple Wallet button
-                response = templates.TemplateResponse('success.html', \
-                    {'request': request, 'pass_hash': db_pass.pass_hash, 'jwt': google.get_link()})
-                logger.info('Existing user successful request for ID (' + entered_id_num + ')')
-            else:
+            if db_pass and db_pass.id_pin != entered_id_pin:
                 # pass for user already exists but login is incorrect,
                 # user not valid through server quick validation
                 response = templates.TemplateResponse('index.html', \
                     {'request': request, 'feedback': 'The ID Number and ID Card Pin Number entered do not match. Please try again.', 'entered_id': entered_id_num})
                 logger.debug('Registration unsuccessful for ID (' + entered_id_num + ') with Pin (' +  entered_id_pin + ')')
+            else:
+                # validate with OC & create the pass in the background,
+                # respond with success page that shows the buttons as they become ready
+                job_id = registration.submit(entered_id_num, entered_id_pin)
+                response = templates.TemplateResponse('success.html', \
+                    {'request': request, 'job_id': job_id, 'poll_interval': config.REGISTRATION_POLL_INTERVAL * 1000, \
+                        'poll_limit': max(1, config.REGISTRATION_POLL_TIMEOUT // config.REGISTRATION_POLL_INTERVAL)})
+                logger.info('Registration queued for ID (' + entered_id_num + ')')
         else:
             # user not valid through server quick validation
             response = templates.TemplateResponse('index.html', \
@@ -296,19 +274,32 @@ def submit(request: Request, idNum: str = Form(...), idPin: str = Form(...), db:
         
     return response
 
+@app.get("/registration/{job_id}", tags=["Registration"])
+async def registration_status(job_id: str):
+    '''
+    Progress of a registration, polled by the success page
+    '''
+    return await offload.run(registration.status, job_id)
+
 @app.post("/download/{pass_hash}", status_code=200, tags=["Registration"])
-def download(request: Request, pass_hash: str, db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.registration)
+def download(request: Request, pass_hash: str, db: Session = None):
     '''
     User can Download Pass
     '''
 
     # user clicks the Add to Apple Wallet button
-    db_pass = crud.get_pass_by_hash(db, pass_hash)
-    if db_pass:
+    serial_number = passindex.index.lookup(db, pass_hash)
+    row = crud.get_pass_row(db, serial_number) if serial_number else None
+    if row:
         # if a pass matching the request is found,
-        # returns the matching pass file
-        response = utils.get_pass_file(db, db_pass.serial_number)
-        logger.info('Pass (' + db_pass.serial_number   + ') downloaded with hash (' + pass_hash + ')')
+        # returns the matching pass file unless the browser has it
+        response = utils.not_modified(request.headers, row)
+        if response:
+            logger.debug('Pass (' + serial_number + ') not modified for hash (' + pass_hash + ')')
+        else:
+            response = utils.get_pass_file(db, row)
+            logger.info('Pass (' + serial_number   + ') downloaded with hash (' + pass_hash + ')')
     else:
         # no matching pass found,
         # returns HTML status no matching data
@@ -336,20 +327,21 @@ MOBIL-ID Back-End Web Service
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
 @app.get("/scan/{pass_hash}", status_code=200, tags=["Reader"])
-async def scan(pass_hash: str, background_tasks: BackgroundTasks, reader: str = None, db: Session = Depends(get_db)):
+async def scan(pass_hash: str, background_tasks: BackgroundTasks, reader: str = None):
     '''
     Scan event converts QR data to serial_number
     '''
 
     logger.debug('Scan recieved for hash (' + pass_hash + ') from reader (' + reader + ')')
-    db_pass = crud.get_pass_by_hash(db, pass_hash)
-    if db_pass:
+    serial_number, rotate = await offload.run(utils.scan_pass, pass_hash, reader=reader)
+    if serial_number:
         # if pass exists with matching pash_hash,
         # respond with the corresponding serial_number
-        response = db_pass.serial_number
-        # start background task to update pass with new pass_hash
-        background_tasks.add_task(utils.force_pass_update, db, response)
-        logger.info('Pass (' + db_pass.serial_number + ') scanned by reader (' + reader + ')')
+        response = serial_number
+        if rotate:
+            # start background task to update pass with new pass_hash
+            background_tasks.add_task(offload.with_session, utils.rotate_passes, [serial_number])
+        logger.info('Pass (' + serial_number + ') scanned by reader (' + reader + ')')
     else:
         # no matching pass found,
         # returns HTML status no matching data
@@ -358,17 +350,68 @@ async def scan(pass_hash: str, background_tasks: BackgroundTasks, reader: str =
 
     return response
 
+@app.post("/scan/batch", status_code=200, tags=["Reader"])
+@bulkhead.isolate(bulkhead.reader)
+def scan_batch(scans: List[Any], background_tasks: BackgroundTasks, reader: str = None):
+    '''
+    Scan events from a busy or reconnecting reader converted to serial_numbers in one request
+    '''
+
+    if len(scans) > config.SCAN_BATCH_MAX:
+        # the reader should split its backlog
+        return Response(status_code=413)
+
+    results, rotate = offload.with_session(utils.scan_batch, scans, reader)
+    if rotate:
+        # start background task to update passes with new pass_hashes
+        background_tasks.add_task(offload.with_session, utils.rotate_passes, rotate)
+    logger.info(str(sum(1 for result in results if result['serial_number'])) + '/' + str(len(results)) + ' batched scans accepted from reader (' + str(reader) + ')')
+
+    return results
+
+@app.websocket("/scan/ws")
+async def scan_stream(websocket: WebSocket, reader: str = None):
+    '''
+    Channel a reader keeps open to convert scans to serial_numbers without a request per scan,
+    each message is one scan or a list of scans and is answered with a list of results
+    '''
+
+    await websocket.accept()
+    logger.info('Reader (' + str(reader) + ') connected')
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                scans = json.loads(message)
+            except ValueError:
+                # a malformed frame doesn't end the reader's connection
+                await websocket.send_json({'error': 'expected a JSON message'})
+                continue
+            if isinstance(scans, dict):
+                scans = [scans]
+            if not isinstance(scans, list) or len(scans) > config.SCAN_BATCH_MAX:
+                await websocket.send_json({'error': 'expected a scan or a list of at most ' + str(config.SCAN_BATCH_MAX) + ' scans'})
+                continue
+
+            results, rotate = await offload.run(utils.scan_batch, scans, reader)
+            await websocket.send_json(results)
+            if rotate:
+                # answered first, the new pass_hashes are made off the event loop
+                await offload.run(utils.rotate_passes, rotate)
+    except WebSocketDisconnect:
+        logger.info('Reader (' + str(reader) + ') disconnected')
+
 @app.get("/{client}/update/{serial_number}", tags=["Client Updates"])
-async def update(client: str, serial_number: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def update(client: str, serial_number: str, background_tasks: BackgroundTasks):
     '''
     Client notifies server of updated user data
     '''
     logger.debug('Client (' + client + ') notified server that ID (' + serial_number + ') has updated')
-    db_pass = crud.get_pass(db, serial_number)
+    db_pass = await offload.run(crud.get_pass_row, serial_number)
     if db_pass:
         # if a pass exists for user,
-        # start background pass update task
-        background_tasks.add_task(utils.update_pass, db, serial_number)
+        # start background pass update task, sync so it runs in the thread pool
+        background_tasks.add_task(offload.with_session, utils.update_pass, serial_number)
         response = Response(status_code=200)
         logger.info('Pass (' + serial_number + ') updated by client (' + client + ') request')
     else:
@@ -379,6 +422,21 @@ async def update(client: str, serial_number: str, background_tasks: BackgroundTa
     
     return response
 
+@app.get("/stats", tags=["Stats"])
+def stats():
+    '''
+    Returns server counters
+    '''
+    return utils.get_stats()
+
+@app.get("/stats/scans", tags=["Stats"])
+def scan_stats(reader: str = None, since: datetime = None, until: datetime = None, db: Session = Depends(get_db)):
+    '''
+    Scans per reader & UTC time bucket, read from the rollups instead of the raw events
+    '''
+    rollups = crud.get_scan_rollups(db, reader, scanlog.utc(since), scanlog.utc(until))
+    return [{'reader': rollup.reader, 'bucket': rollup.bucket, 'scans': rollup.scans, 'accepted': rollup.accepted} for rollup in rollups]
+
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 Scheduled Tasks
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
@@ -397,14 +455,69 @@ def batch_update_all():
     pass_list = crud.get_all_passes(db)
 
     count = 0
-    for serial_number in pass_list:
-        logger.debug('Trying to update pass (' + serial_number + ')')
-        count += 1
-        utils.update_pass(db,serial_number)
+    google_batch = list()
+    for index in range(0, len(pass_list), config.PASS_UPDATE_CHUNK):
+        chunk = pass_list[index:index + config.PASS_UPDATE_CHUNK]
+        logger.debug('Trying to update passes (' + chunk[0] + ' - ' + chunk[-1] + ')')
+        count += len(chunk)
+        # one transaction per chunk
+        # Google objects are synced in batches
+        google_batch.extend(utils.batch_update_passes(db, chunk))
+        while len(google_batch) >= config.GOOGLE_BATCH_SIZE:
+            pipeline.dispatch_google_batch(google_batch[:config.GOOGLE_BATCH_SIZE])
+            google_batch = google_batch[config.GOOGLE_BATCH_SIZE:]
+    pipeline.dispatch_google_batch(google_batch)
 
     db.close()
     logger.info('Finished batch update process for (' + str(count) + ') passes.')
 
+@sched.scheduled_job('interval', seconds=config.DB_CHECKPOINT_INTERVAL)
+def checkpoint_database():
+    '''
+    Keeps the SQLite write-ahead log small
+    '''
+    database.checkpoint()
+
+@sched.scheduled_job('interval', seconds=config.BARCODE_PURGE_INTERVAL)
+def purge_seen_barcodes():
+    '''
+    Forgets scanned barcodes whose replay window has passed
+    '''
+    db = SessionLocal()
+    try:
+        crud.purge_seen_barcodes(db, datetime.utcnow())
+    finally:
+        db.close()
+
+@sched.scheduled_job('interval', seconds=config.REGISTRATION_JOB_TTL)
+def purge_registration_jobs():
+    '''
+    Forgets finished registration jobs that can no longer be polled
+    '''
+    db = SessionLocal()
+    try:
+        crud.purge_registration_jobs(db, datetime.utcnow() - timedelta(seconds=config.REGISTRATION_JOB_TTL))
+    finally:
+        db.close()
+
+@sched.scheduled_job('interval', seconds=config.BLOB_DELETE_GRACE)
+def sweep_blobs():
+    '''
+    Deletes superseded pkpass files & hero images once their grace period has passed
+    '''
+    db = SessionLocal()
+    try:
+        crud.sweep_blobs(db, datetime.utcnow() - timedelta(seconds=config.BLOB_DELETE_GRACE))
+    finally:
+        db.close()
+
+@sched.scheduled_job('interval', start_date=str(datetime.now().replace(hour=3, minute=0, second=0, microsecond=0)), days=1)
+def analyze_database():
+    '''
+    Refreshes query planner statistics at 3:00:00 daily
+    '''
+    database.analyze()
+
 @sched.scheduled_job('interval', start_date=str(datetime.now().replace(hour=21, minute=0, second=0, microsecond=0)), days=1)
 def nightly_brief():
     '''
@@ -412,10 +525,43 @@ def nightly_brief():
     '''
     utils.send_notification('Daily Brief', utils.get_log(LOG_FILE))
 
+@app.on_event("startup")
+def startup_event():
+    '''
+    Loads the scan index & provisions the Google Pay class once so per-pass work only touches objects
+    '''
+    db = SessionLocal()
+    try:
+        try:
+            passindex.index.load(db)
+        except Exception as err:
+            # the first scan will retry loading
+            db.rollback()
+            logger.error('Scan index load failed: ' + str(err))
+        try:
+            utils.provision_google_class(db)
+        except Exception as err:
+            # passes will retry provisioning lazily
+            logger.error('Google class provisioning failed: ' + str(err))
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_watchdog():
+    '''
+    Watches the event loop for blocking calls that slipped past the offload boundary
+    '''
+    offload.watchdog.start()
+
 @app.on_event("shutdown")
 def shutdown_event():
     global sched
     sched.shutdown()
+    pipeline.shutdown()
+    scanlog.writer.shutdown()
+    offload.watchdog.stop()
+    bulkhead.shutdown()
+    registration.shutdown()
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 Development Tools for Web Service
@@ -431,7 +577,8 @@ def reader(request: Request):
     return response
 
 @app.post("/reader", tags=["Test"])
-def reader_post(request: Request, idNum: str = Form(...), db: Session = Depends(get_db)):
+@bulkhead.isolate(bulkhead.reader)
+def reader_post(request: Request, idNum: str = Form(...), db: Session = None):
     '''
     Returns user data on form submit
     '''
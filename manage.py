@@ -0,0 +1,58 @@
+''' manage.py: Administrative commands for the MOBIL-ID Server
+
+Usage:
+    python manage.py migrate
+    python manage.py import-files
+    python manage.py provision-class [--force]
+'''
+
+import argparse
+
+import include.utils as utils, include.models as models, include.migrations as migrations # local imports
+from include.database import SessionLocal, engine
+
+def provision_class(args):
+    '''
+    Inserts or updates the Google Pay class definition
+    '''
+    db = SessionLocal()
+    try:
+        if utils.provision_google_class(db, args.force):
+            print('Google class provisioned.')
+        else:
+            print('Google class is up to date.')
+    finally:
+        db.close()
+
+def migrate(args):
+    '''
+    Brings an existing database up to date (also runs at server start)
+    '''
+    migrations.migrate(engine)
+    print('Database is up to date.')
+
+def import_files(args):
+    '''
+    Copies passes & hero images from passes/ & static/heroImg/ into the blob store
+    '''
+    with engine.begin() as conn:
+        migrations.import_files(conn)
+    print('Files imported into the blob store.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MOBIL-ID Server administrative commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('migrate', help='bring an existing database up to date')
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('import-files', help='copy passes & hero images written by older versions into the blob store')
+    command.set_defaults(func=import_files)
+
+    command = commands.add_parser('provision-class', help='insert or update the Google Pay class')
+    command.add_argument('--force', action='store_true', help='push the class definition even if it is unchanged')
+    command.set_defaults(func=provision_class)
+
+    args = parser.parse_args()
+    models.Base.metadata.create_all(bind=engine)
+    args.func(args)
@@ -0,0 +1,17 @@
+'''
+conftest.py: Runs the tests from a scratch directory with the sample configuration,
+so the database, blob store & logs the server creates don't land in the repository.
+'''
+
+import importlib, os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if not os.path.exists(os.path.join(ROOT, 'config.py')):
+    sys.modules['config'] = importlib.import_module('config_sample')
+
+WORKDIR = tempfile.mkdtemp(prefix='mobil-id-tests-')
+for name in ('static', 'templates', 'base.pass'):
+    os.symlink(os.path.join(ROOT, name), os.path.join(WORKDIR, name))
+os.chdir(WORKDIR)
@@ -0,0 +1,56 @@
+'''
+test_barcode.py: Replay protection is shared by every worker
+'''
+
+import time
+
+import pytest
+
+import main, config
+import include.barcode as barcode
+from include.database import SessionLocal
+
+@pytest.fixture
+def hmac_mode(monkeypatch):
+    monkeypatch.setattr(config, 'BARCODE_MODE', 'hmac')
+    monkeypatch.setattr(config, 'BARCODE_SECRET', 'test-secret')
+
+def totp_message(serial_number: str, now: float):
+    return serial_number + barcode.SEPARATOR + barcode.totp(barcode.pass_secret(serial_number), int(now) // config.BARCODE_PERIOD)
+
+def test_replay_refused_by_other_worker(hmac_mode):
+    now = time.time()
+    message = totp_message('replay', now)
+    # a session per worker, only the database is shared
+    worker_a, worker_b = SessionLocal(), SessionLocal()
+    try:
+        assert barcode.verify(worker_a, message, now, 'gate-1') is not None
+        assert barcode.verify(worker_b, message, now + 1, 'gate-2') is None
+        assert barcode.verify(worker_b, message, now + 1) is None
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+def test_same_reader_may_retry(hmac_mode):
+    now = time.time()
+    message = totp_message('retry', now)
+    worker_a, worker_b = SessionLocal(), SessionLocal()
+    try:
+        assert barcode.verify(worker_a, message, now, 'gate-1') is not None
+        assert barcode.verify(worker_b, message, now + 1, 'gate-1') is not None
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+def test_apple_barcode_expires(hmac_mode):
+    now = time.time()
+    db = SessionLocal()
+    try:
+        fresh = barcode.apple_message('apple', int(now) - 60)
+        old = barcode.apple_message('apple', int(now) - config.BARCODE_MAX_AGE - 1)
+        assert barcode.verify(db, fresh, now, 'gate-1') is not None
+        # static, so it is accepted again once the replay window has passed
+        assert barcode.verify(db, fresh, now + config.BARCODE_REPLAY_WINDOW + 1, 'gate-2') is not None
+        assert barcode.verify(db, old, now, 'gate-1') is None
+    finally:
+        db.close()
@@ -0,0 +1,51 @@
+'''
+test_blob_sweep.py: Superseded blobs are deleted by the sweep, never while a reference is on its way
+'''
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+import include.crud as crud, include.storage as storage
+from include.database import SessionLocal
+from include.models import Pass
+
+@pytest.fixture
+def db():
+    db = SessionLocal()
+    yield db
+    db.close()
+
+def add_pass(db, serial_number: str):
+    db.add(Pass(serial_number=serial_number, pass_hash='hash-' + serial_number, last_update=datetime(2026, 1, 1)))
+    db.commit()
+
+def later():
+    # a sweep that runs once the grace period has passed
+    return datetime.utcnow() + timedelta(seconds=1)
+
+def test_superseded_blob_waits_for_sweep(db):
+    add_pass(db, 'sweep-1')
+    old_key = storage.store.put(b'sweep-1 old pkpass')
+    crud.set_pkpass(db, 'sweep-1', old_key, 'etag-1', datetime(2026, 1, 1))
+    crud.set_pkpass(db, 'sweep-1', storage.store.put(b'sweep-1 new pkpass'), 'etag-2', datetime(2026, 1, 2))
+
+    assert storage.store.exists(old_key)
+    assert crud.sweep_blobs(db, datetime.utcnow() - timedelta(hours=1)) == 0
+    assert storage.store.exists(old_key)
+    crud.sweep_blobs(db, later())
+    assert not storage.store.exists(old_key)
+
+def test_reference_committed_after_release_keeps_blob(db):
+    add_pass(db, 'sweep-2')
+    add_pass(db, 'sweep-3')
+    shared_key = storage.store.put(b'same hero image')
+    crud.set_hero_key(db, 'sweep-2', shared_key)
+    # another request puts the same image, then the first pass drops it before that request commits
+    assert storage.store.put(b'same hero image') == shared_key
+    crud.set_hero_key(db, 'sweep-2', storage.store.put(b'sweep-2 new hero image'))
+    crud.set_hero_key(db, 'sweep-3', shared_key)
+
+    crud.sweep_blobs(db, later())
+    assert storage.store.exists(shared_key)
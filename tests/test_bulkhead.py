@@ -0,0 +1,31 @@
+'''
+test_bulkhead.py: Device endpoints don't need a thread of the shared default pool
+'''
+
+import asyncio
+
+import anyio.to_thread
+import httpx
+
+import main
+
+async def poll_while_default_pool_busy():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    total_tokens = limiter.total_tokens
+    # background tasks & scans holding every default thread
+    holders = [object(), object()]
+    limiter.total_tokens = len(holders)
+    for holder in holders:
+        await limiter.acquire_on_behalf_of(holder)
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await asyncio.wait_for(client.get('/v1/devices/device/registrations/pass.type'), 2)
+    finally:
+        for holder in holders:
+            limiter.release_on_behalf_of(holder)
+        limiter.total_tokens = total_tokens
+
+def test_device_poll_skips_default_pool():
+    response = asyncio.run(poll_while_default_pool_busy())
+    assert response.status_code == 204
@@ -0,0 +1,34 @@
+'''
+test_devicelists.py: The reverse index of cached device lists stays as bounded as the cache
+'''
+
+import main
+import include.devicelists as devicelists
+from include.cache import LRUCache
+
+def make_lists(monkeypatch, size: int):
+    lists = devicelists.DeviceLists()
+    lists.entries = LRUCache(size, on_evict=lists.forget)
+    monkeypatch.setattr(lists, 'sync', lambda db: None)
+    monkeypatch.setattr(devicelists.passindex.index, 'sync', lambda db: None)
+    # every device has its own pass & one shared by all of them
+    monkeypatch.setattr(devicelists.crud, 'get_device_passes', lambda db, device_id: {'own-' + device_id: 1, 'shared': 1})
+    return lists
+
+def test_evicted_devices_leave_the_index(monkeypatch):
+    lists = make_lists(monkeypatch, 2)
+    for number in range(10):
+        lists.get(None, 'device-' + str(number))
+
+    assert len(lists.entries) == 2
+    assert set(lists.devices) == {'own-device-8', 'own-device-9', 'shared'}
+    assert lists.devices['shared'] == {'device-8', 'device-9'}
+
+def test_invalidated_devices_leave_the_index(monkeypatch):
+    lists = make_lists(monkeypatch, 10)
+    lists.get(None, 'device-1')
+    lists.get(None, 'device-2')
+
+    lists.pass_changed('own-device-1')
+    lists.device_changed('device-2')
+    assert lists.devices == {}
@@ -0,0 +1,29 @@
+'''
+test_google_batch.py: Calls throttled or failed inside a batch reach the rate limiter & counters
+'''
+
+import include.google.restMethods as restMethods
+
+class BatchResponse():
+    def __init__(self, statuses: dict):
+        self.headers = {'Content-Type': 'multipart/mixed; boundary=batch_test'}
+        self.text = ''
+        for contentId, statusCode in statuses.items():
+            self.text += '--batch_test\r\nContent-Type: application/http\r\nContent-ID: <response-' + contentId + '>\r\n\r\n'
+            self.text += 'HTTP/1.1 ' + str(statusCode) + ' X\r\nContent-Type: application/json\r\n\r\n{}\r\n'
+        self.text += '--batch_test--\r\n'
+
+def test_item_statuses_are_counted(monkeypatch):
+    limiter = restMethods.TokenBucket(20, 20)
+    monkeypatch.setattr(restMethods, '_rateLimiter', limiter)
+    before = restMethods.getStats()
+
+    responses = restMethods.parseBatchResponse(BatchResponse({'a': 200, 'b': 503, 'c': 500, 'd': 429, 'e': 429}))
+    restMethods.countBatchStatuses(responses)
+
+    after = restMethods.getStats()
+    assert responses['b'][0] == 503
+    assert after['server_errors'] - before['server_errors'] == 2
+    assert after['throttled'] - before['throttled'] == 2
+    # halved once for the whole batch
+    assert limiter.rate == 10
@@ -0,0 +1,30 @@
+'''
+test_google_sync.py: A pass deleted while its Google batch is pending doesn't abort the batch
+'''
+
+from collections import namedtuple
+from datetime import datetime
+
+import main
+import include.utils as utils
+from include.database import SessionLocal
+from include.models import Pass
+
+Rendered = namedtuple('Rendered', ['serial_number', 'hero_image_version'])
+
+def test_deleted_pass_skipped(monkeypatch):
+    synced = list()
+    def batch_sync_objects(db, vertical_type, class_id, items):
+        synced.extend(user_pass.serial_number for user_pass, _ in items)
+        return {user_pass.serial_number: 'inserted' for user_pass, _ in items}
+    monkeypatch.setattr(utils.services, 'batchSyncObjects', batch_sync_objects)
+
+    db = SessionLocal()
+    try:
+        db.add(Pass(serial_number='google-1', pass_hash='hash-google-1', last_update=datetime(2026, 1, 1)))
+        db.commit()
+        failed = utils.batch_sync_google(db, [Rendered('google-1', 'v1'), Rendered('google-deleted', 'v2')])
+    finally:
+        db.close()
+    assert failed == []
+    assert synced == ['google-1']
@@ -0,0 +1,32 @@
+'''
+test_legacy_files.py: Passes built before the blob store are served until they are imported
+'''
+
+import os
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+import main
+import include.migrations as migrations
+from include.database import SessionLocal
+from include.models import Pass
+
+def test_legacy_pkpass_served_without_key():
+    db = SessionLocal()
+    db.add(Pass(serial_number='legacy-1', pass_hash='hash-legacy-1', auth_token='token', last_update=datetime(2026, 1, 1)))
+    db.commit()
+    db.close()
+    path = migrations.LEGACY_PKPASS.format('legacy-1')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as legacy_file:
+        legacy_file.write(b'legacy pkpass')
+
+    client = TestClient(main.app)
+    headers = {'Authorization': 'ApplePass token'}
+    response = client.get('/v1/passes/pass.type/legacy-1', headers=headers)
+    assert response.status_code == 200
+    assert response.content == b'legacy pkpass'
+
+    os.remove(path)
+    assert client.get('/v1/passes/pass.type/legacy-1', headers=headers).status_code == 404
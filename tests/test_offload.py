@@ -0,0 +1,53 @@
+'''
+test_offload.py: Blocking scan work runs off the event loop
+'''
+
+import asyncio, time
+
+import httpx
+
+import main
+import include.utils as utils
+
+SCAN_SECONDS = 0.5
+
+def slow_scan_pass(db, message: str, scanned_at: float = None, reader: str = None):
+    if message == 'slow':
+        # a database or HMAC call stuck on a lock
+        time.sleep(SCAN_SECONDS)
+    return message, False
+
+async def heartbeat(stop: asyncio.Event, gaps: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        gaps.append(time.perf_counter() - start)
+
+async def scan_while_blocked():
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+        stop = asyncio.Event()
+        gaps = list()
+        beats = asyncio.create_task(heartbeat(stop, gaps))
+        slow = asyncio.create_task(client.get('/scan/slow', params={'reader': 'r1'}))
+        await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        fast = await client.get('/scan/fast', params={'reader': 'r2'})
+        fast_seconds = time.perf_counter() - start
+
+        slow = await slow
+        stop.set()
+        await beats
+    return slow, fast, fast_seconds, gaps
+
+def test_slow_scan_does_not_block_the_loop(monkeypatch):
+    monkeypatch.setattr(utils, 'scan_pass', slow_scan_pass)
+    slow, fast, fast_seconds, gaps = asyncio.run(scan_while_blocked())
+
+    assert slow.status_code == 200 and slow.json() == 'slow'
+    assert fast.status_code == 200 and fast.json() == 'fast'
+    # answered while the slow scan still held its thread
+    assert fast_seconds < SCAN_SECONDS / 2
+    # the loop kept waking up on time throughout
+    assert max(gaps) < SCAN_SECONDS / 2
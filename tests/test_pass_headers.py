@@ -0,0 +1,27 @@
+'''
+test_pass_headers.py: If-Modified-Since is compared with the time Last-Modified was sent from
+'''
+
+from collections import namedtuple
+from datetime import datetime
+
+import include.utils as utils
+
+Row = namedtuple('Row', ['etag', 'built_at', 'last_update'])
+
+def revalidate(row):
+    return utils.not_modified({'if-modified-since': utils.pass_headers(row)['Last-Modified']}, row)
+
+def test_built_before_last_update():
+    # the data changed after the pkpass was built, the rebuild hasn't finished
+    row = Row(None, datetime(2026, 1, 1, 12, 0, 0), datetime(2026, 1, 1, 12, 5, 0))
+    assert revalidate(row).status_code == 304
+
+def test_built_after_last_update():
+    row = Row(None, datetime(2026, 1, 1, 12, 5, 0, 500000), datetime(2026, 1, 1, 12, 0, 0))
+    assert revalidate(row).status_code == 304
+    assert utils.not_modified({'if-modified-since': 'Thu, 01 Jan 2026 12:04:59 GMT'}, row) is None
+
+def test_legacy_row_without_build_time():
+    row = Row(None, None, datetime(2026, 1, 1, 12, 0, 0))
+    assert revalidate(row).status_code == 304
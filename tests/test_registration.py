@@ -0,0 +1,43 @@
+'''
+test_registration.py: Any worker can answer a poll of a finished registration job
+'''
+
+import main
+import include.registration as registration
+from include.database import SessionLocal
+
+class InvalidUser():
+    def __init__(self, id_num: str, id_pin: str):
+        pass
+
+    def is_valid(self):
+        return False
+
+def poll_from_other_worker(job: registration.Job):
+    # the job ran elsewhere, so it isn't in this worker's cache
+    registration.jobs.pop(job.id)
+    db = SessionLocal()
+    try:
+        return registration.status(db, job.id)
+    finally:
+        db.close()
+
+def test_rejected_id_is_seen_by_other_workers(monkeypatch):
+    monkeypatch.setattr(registration.schemas, 'User', InvalidUser)
+    job = registration.Job('9990001', '1234')
+    registration.run(job)
+    assert job.state == 'invalid'
+    assert poll_from_other_worker(job) == {'state': 'invalid'}
+
+def test_failed_build_is_seen_by_other_workers(monkeypatch):
+    def broken_build(db, job):
+        raise RuntimeError('OC is down')
+    monkeypatch.setattr(registration, 'build', broken_build)
+    job = registration.Job('9990002', '1234')
+    registration.run(job)
+    assert job.state == 'failed'
+    assert poll_from_other_worker(job) == {'state': 'failed'}
+
+def test_unfinished_job_is_pending():
+    job = registration.Job('9990003', '1234')
+    assert poll_from_other_worker(job) == {'state': 'pending'}
@@ -0,0 +1,116 @@
+'''
+test_registrations.py: Device registrations are upserted & a device leaves with its last registration
+'''
+
+import threading
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import IntegrityError
+
+import main
+import include.crud as crud, include.migrations as migrations
+from include.database import SessionLocal
+from include.models import Base, Device, Pass, Registration
+
+HEADERS = {'Authorization': 'ApplePass token'}
+
+@pytest.fixture
+def db():
+    db = SessionLocal()
+    yield db
+    db.close()
+
+def add_pass(db, serial_number: str):
+    db.add(Pass(serial_number=serial_number, pass_hash='hash-' + serial_number, auth_token='token', last_update=datetime(2026, 1, 1)))
+    db.commit()
+
+def url(device_id: str, serial_number: str):
+    return '/v1/devices/' + device_id + '/registrations/pass.type/' + serial_number
+
+def registrations(db, device_id: str):
+    return sorted(serial_number for (serial_number,) in db.query(Registration.serial_number).filter(Registration.device_id==device_id))
+
+def push_token(db, device_id: str):
+    db.expire_all()
+    return db.query(Device.push_token).filter(Device.device_id==device_id).scalar()
+
+def test_register_again_is_idempotent(db):
+    add_pass(db, 'reg-1')
+    client = TestClient(main.app)
+    assert client.post(url('device-a', 'reg-1'), json={'pushToken': 'first'}, headers=HEADERS).status_code == 201
+    # a restored device registers again with a new push token
+    assert client.post(url('device-a', 'reg-1'), json={'pushToken': 'second'}, headers=HEADERS).status_code == 200
+    assert registrations(db, 'device-a') == ['reg-1']
+    assert push_token(db, 'device-a') == 'second'
+
+def test_last_unregister_deletes_device(db):
+    add_pass(db, 'reg-2')
+    add_pass(db, 'reg-3')
+    client = TestClient(main.app)
+    client.post(url('device-b', 'reg-2'), json={'pushToken': 'token-b'}, headers=HEADERS)
+    client.post(url('device-b', 'reg-3'), json={'pushToken': 'token-b'}, headers=HEADERS)
+
+    assert client.delete(url('device-b', 'reg-2'), headers=HEADERS).status_code == 200
+    assert push_token(db, 'device-b') == 'token-b'
+    assert client.delete(url('device-b', 'reg-3'), headers=HEADERS).status_code == 200
+    assert push_token(db, 'device-b') is None
+    assert registrations(db, 'device-b') == []
+
+def test_duplicate_registration_rejected(db):
+    db.execute(insert(Registration), [{'device_id': 'device-c', 'serial_number': 'reg-4'}])
+    with pytest.raises(IntegrityError):
+        db.execute(insert(Registration), [{'device_id': 'device-c', 'serial_number': 'reg-4'}])
+    db.rollback()
+
+def test_migration_dedupes_before_indexing(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'old.db'))
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        # a database from before the unique index
+        conn.exec_driver_sql('DROP INDEX ix_registrations_device_serial')
+        conn.execute(insert(Registration), [{'device_id': 'device-d', 'serial_number': 'reg-5'}] * 3)
+    migrations.migrate(engine)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT COUNT(*) FROM registrations').scalar() == 1
+    engine.dispose()
+
+def test_register_after_delete_keeps_device(db):
+    add_pass(db, 'reg-6')
+    add_pass(db, 'reg-7')
+    crud.register_device(db, 'device-e', 'token-e', 'reg-6')
+    # the last registration goes & the device with it, then the device registers another pass
+    crud.unregister_device(db, 'device-e', 'reg-6')
+    assert crud.register_device(db, 'device-e', 'token-e', 'reg-7')
+    assert registrations(db, 'device-e') == ['reg-7']
+    assert push_token(db, 'device-e') == 'token-e'
+
+def test_concurrent_register_and_delete(db):
+    add_pass(db, 'reg-8')
+    add_pass(db, 'reg-9')
+    errors = list()
+
+    def run(func, *args):
+        session = SessionLocal()
+        try:
+            func(session, *args)
+        except Exception as err:
+            errors.append(err)
+        finally:
+            session.close()
+
+    for attempt in range(20):
+        device_id = 'device-f' + str(attempt)
+        crud.register_device(db, device_id, 'token-f', 'reg-8')
+        threads = [threading.Thread(target=run, args=(crud.unregister_device, device_id, 'reg-8')),
+            threading.Thread(target=run, args=(crud.register_device, device_id, 'token-f', 'reg-9'))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # whichever committed first, the device outlives its remaining registration
+        assert registrations(db, device_id) == ['reg-9']
+        assert push_token(db, device_id) == 'token-f'
+    assert errors == []
@@ -0,0 +1,24 @@
+'''
+test_scan_batch.py: One malformed scan doesn't cost a reader the rest of its batch
+'''
+
+from fastapi.testclient import TestClient
+
+import main
+
+def test_bad_item_gets_its_own_error():
+    client = TestClient(main.app)
+    response = client.post('/scan/batch?reader=r1', json=[{'id': 1, 'hash': 'unknown'}, 'garbage', {'id': 3, 'hash': 7}])
+    assert response.status_code == 200
+    first, second, third = response.json()
+    assert first == {'id': 1, 'hash': 'unknown', 'serial_number': None}
+    assert 'error' in second
+    assert third['id'] == 3 and 'error' in third
+
+def test_websocket_reports_bad_items_the_same_way():
+    client = TestClient(main.app)
+    with client.websocket_connect('/scan/ws?reader=r1') as websocket:
+        websocket.send_json([{'id': 1, 'hash': 'unknown'}, 'garbage'])
+        first, second = websocket.receive_json()
+        assert 'error' not in first
+        assert 'error' in second
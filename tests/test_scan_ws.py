@@ -0,0 +1,15 @@
+'''
+test_scan_ws.py: The scan WebSocket survives malformed messages
+'''
+
+from fastapi.testclient import TestClient
+
+import main
+
+def test_malformed_frame_keeps_connection():
+    client = TestClient(main.app)
+    with client.websocket_connect('/scan/ws?reader=r1') as websocket:
+        websocket.send_text('not json')
+        assert 'error' in websocket.receive_json()
+        websocket.send_text('[]')
+        assert websocket.receive_json() == []
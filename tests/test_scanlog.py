@@ -0,0 +1,30 @@
+'''
+test_scanlog.py: Scan rollup buckets are UTC whatever the server's timezone
+'''
+
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import config
+import include.scanlog as scanlog
+
+@pytest.fixture(params=['UTC', 'America/Chicago', 'Asia/Kolkata'])
+def server_timezone(request, monkeypatch):
+    monkeypatch.setenv('TZ', request.param)
+    time.tzset()
+    yield request.param
+    monkeypatch.delenv('TZ')
+    time.tzset()
+
+def test_bucket_is_utc(server_timezone, monkeypatch):
+    monkeypatch.setattr(config, 'SCAN_ROLLUP_BUCKET', 3600)
+    # 10:42:07 UTC
+    scanned_at = datetime(2026, 3, 8, 10, 42, 7)
+    assert scanlog.bucket_of(scanned_at) == datetime(2026, 3, 8, 10, 0, 0)
+
+def test_aware_times_become_naive_utc():
+    chicago = timezone(timedelta(hours=-6))
+    assert scanlog.utc(datetime(2026, 3, 8, 4, 42, tzinfo=chicago)) == datetime(2026, 3, 8, 10, 42)
+    assert scanlog.utc(datetime(2026, 3, 8, 10, 42)) == datetime(2026, 3, 8, 10, 42)
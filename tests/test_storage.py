@@ -0,0 +1,99 @@
+'''
+test_storage.py: Both blob store backends, S3 through an in-memory stand-in of the boto3 client
+'''
+
+import hashlib
+from io import BytesIO
+
+import pytest
+
+import include.storage as storage
+
+class ClientError(Exception):
+    '''
+    Shaped like botocore's ClientError
+    '''
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+class Body():
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def iter_chunks(self, chunk_size: int):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+class FakeS3():
+    '''
+    The calls S3BlobStore makes, against a dict
+    '''
+    def __init__(self):
+        self.objects = {}
+        self.uploads = 0
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError('404')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        self.uploads += 1
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError('NoSuchKey')
+        data = self.objects[(Bucket, Key)]
+        return {'Body': Body(data), 'ContentLength': len(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmp_path):
+    if request.param == 'local':
+        return storage.LocalBlobStore(str(tmp_path))
+    return storage.S3BlobStore('bucket', 'blobs/', client=FakeS3())
+
+def test_put_returns_content_hash(store):
+    data = b'pkpass' * 50000
+    key = store.put(data)
+    assert key == hashlib.sha256(data).hexdigest()
+    assert store.exists(key)
+    assert store.read(key) == data
+
+def test_streamed_put_and_read(store):
+    data = bytes(range(256)) * 1000
+    key = store.put(BytesIO(data))
+    blob, size = store.stream(key)
+    blob = list(blob)
+    assert size == len(data)
+    assert len(blob) > 1
+    assert b''.join(blob) == data
+
+def test_identical_blobs_are_stored_once(store):
+    assert store.put(b'hero') == store.put(BytesIO(b'hero'))
+    assert store.stats()['deduplicated'] == 1
+    if isinstance(store, storage.S3BlobStore):
+        assert store.client.uploads == 1
+
+def test_delete(store):
+    key = store.put(b'old pass')
+    store.delete(key)
+    assert not store.exists(key)
+    # deleting again is harmless
+    store.delete(key)
+    with pytest.raises(FileNotFoundError):
+        store.stream(key)
+
+def test_invalid_keys_are_missing(store):
+    assert not store.exists('../../config.py')
+    with pytest.raises(FileNotFoundError):
+        store.stream('../../config.py')
+
+def test_s3_keys_are_sharded_under_prefix():
+    client = FakeS3()
+    key = storage.S3BlobStore('bucket', 'blobs/', client=client).put(b'data')
+    assert list(client.objects) == [('bucket', 'blobs/' + key[:2] + '/' + key[2:4] + '/' + key)]